@@ -0,0 +1,448 @@
+"""
+Benchmark della pipeline di luppoloabirra_latex.py.
+
+Genera un albero di documentazione sintetico ricco di diagrammi Mermaid,
+sostituisce mmdc e pdflatex con stub che simulano una latenza configurabile
+ed esegue la pipeline misurando tempo reale, tempo CPU, picco di memoria e
+tempi per fase (dalla traccia di --profile). I risultati vengono salvati in
+JSON per confrontare esecuzioni diverse nel tempo, senza Chromium né TeX.
+
+Esempio:
+    python benchmark_build.py --chapters 10 --diagrams 5 --size medium \
+        --mmdc-latency 0.3 --latex-latency 0.5 --runs 3 -- --jobs 4
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PIPELINE_SCRIPT = os.path.join(SCRIPT_DIR, "luppoloabirra_latex.py")
+
+DIAGRAM_TYPES = ("flowchart-LR", "flowchart-TD", "sequence", "class", "gantt", "pie")
+DIAGRAM_SIZES = {"small": 5, "medium": 15, "large": 40}
+
+# PNG valido (bianco, con le dimensioni richieste), condiviso dagli stub di render
+STUB_PNG_WRITER = r'''
+import struct, zlib
+
+def png_bytes(width, height):
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body) & 0xffffffff)
+    row = b"\x00" + b"\xff" * (width * 3)
+    image = zlib.compress(row * height)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", image) + chunk(b"IEND", b""))
+'''
+
+STUB_PDF_WRITER = r'''
+def pdf_bytes(pages, width=595, height=842):
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + i} 0 R" for i in range(pages))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+    for _ in range(pages):
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] >>".encode())
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return out
+'''
+
+STUB_MMDC = STUB_PNG_WRITER + STUB_PDF_WRITER + r'''
+import os, sys, time
+
+args = sys.argv[1:]
+if "--version" in args:
+    print("10.9.1-bench")
+    sys.exit(0)
+
+def option(name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+time.sleep(float(os.environ.get("BENCH_MMDC_LATENCY", "0.2")))
+output = option("-o")
+width, height = int(option("-w", 800)), int(option("-H", 600))
+if output.endswith(".png"):
+    with open(output, "wb") as f:
+        f.write(png_bytes(width, height))
+elif output.endswith(".svg"):
+    with open(output, "w") as f:
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width / 2} {height / 2}"></svg>')
+else:
+    with open(output, "wb") as f:
+        f.write(pdf_bytes(1, width // 2, height // 2))
+'''
+
+STUB_PDFLATEX = STUB_PDF_WRITER + r'''
+import os, re, sys, time
+
+FRONTMATTER_PAGES = 2
+CHAPTER_PAGES = 5
+
+# Argomento finale: il file principale oppure "\\includeonly{...}\\input{main.tex}"
+source = sys.argv[-1]
+jobname = os.path.splitext(os.path.basename(source))[0]
+for arg in sys.argv[1:]:
+    if arg.startswith("-jobname="):
+        jobname = arg.split("=", 1)[1]
+input_match = re.search(r"\\input\{([^}]*)\}", source)
+main_tex = input_match.group(1) if input_match else source
+try:
+    with open(main_tex, encoding="utf-8") as f:
+        chapters = len(re.findall(r"\\include\{", f.read()))
+except OSError:
+    chapters = 0
+only_match = re.search(r"\\includeonly\{([^}]*)\}", source)
+included = chapters if only_match is None else len([c for c in only_match.group(1).split(",") if c.strip()])
+pages = FRONTMATTER_PAGES + CHAPTER_PAGES * included
+
+# La latenza vale per il documento completo: un \\includeonly compone solo
+# le pagine dei capitoli inclusi
+full_pages = FRONTMATTER_PAGES + CHAPTER_PAGES * max(chapters, included)
+time.sleep(float(os.environ.get("BENCH_LATEX_LATENCY", "0.3")) * pages / full_pages)
+
+# I riferimenti si stabilizzano dopo BENCH_LATEX_SETTLE passaggi
+settle = int(os.environ.get("BENCH_LATEX_SETTLE", "2"))
+state_file = jobname + ".benchpass"
+passes = int(open(state_file).read()) + 1 if os.path.exists(state_file) else 1
+with open(state_file, "w") as f:
+    f.write(str(passes))
+with open(jobname + ".aux", "w") as f:
+    f.write(f"\\relax %% stato {min(passes, settle)}\n")
+with open(jobname + ".toc", "w") as f:
+    f.write(f"%% indice {min(passes, settle)}\n")
+print("This is pdfTeX (stub di benchmark)")
+if passes < settle:
+    print("LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right.")
+if "-draftmode" not in sys.argv:
+    with open(jobname + ".pdf", "wb") as f:
+        f.write(pdf_bytes(pages))
+with open(jobname + ".log", "w") as f:
+    f.write("stub\n")
+'''
+
+STUB_BATCH_RENDERER = STUB_PNG_WRITER + STUB_PDF_WRITER + r'''
+import os, sys, json, time, base64
+
+latency = float(os.environ.get("BENCH_BATCH_LATENCY", "0.05"))
+sys.stdout.write(json.dumps({"ready": True}) + "\n")
+sys.stdout.flush()
+for line in sys.stdin:
+    request = json.loads(line)
+    time.sleep(latency)
+    if request.get("format", "png") == "png":
+        data = png_bytes(request.get("width") or 800, request.get("height") or 600)
+    else:
+        data = pdf_bytes(1, (request.get("width") or 800) // 2, (request.get("height") or 600) // 2)
+    sys.stdout.write(json.dumps({"id": request["id"], "ok": True, "data": base64.b64encode(data).decode()}) + "\n")
+    sys.stdout.flush()
+'''
+
+def generate_diagram(diagram_type, elements, seed):
+    """
+    Restituisce il sorgente Mermaid di un diagramma sintetico con circa
+    `elements` nodi/messaggi; `seed` lo rende unico nel documento.
+    """
+    lines = []
+    if diagram_type.startswith("flowchart"):
+        direction = diagram_type.split("-")[1]
+        lines.append(f"flowchart {direction}")
+        for i in range(elements):
+            lines.append(f"    N{seed}_{i}[Nodo {seed}.{i}] --> N{seed}_{i + 1}[Nodo {seed}.{i + 1}]")
+    elif diagram_type == "sequence":
+        lines.append("sequenceDiagram")
+        actors = ["Client", "Server", "Database", "Cache"]
+        for i in range(elements):
+            source, target = actors[i % len(actors)], actors[(i + 1) % len(actors)]
+            lines.append(f"    {source}->>{target}: Messaggio {seed}.{i}")
+    elif diagram_type == "class":
+        lines.append("classDiagram")
+        for i in range(elements):
+            lines.append(f"    class C{seed}_{i} {{\n        +int campo{i}\n        +metodo{i}()\n    }}")
+            if i:
+                lines.append(f"    C{seed}_{i - 1} --> C{seed}_{i}")
+    elif diagram_type == "gantt":
+        lines.append("gantt")
+        lines.append(f"    title Pianificazione {seed}")
+        lines.append("    dateFormat YYYY-MM-DD")
+        lines.append("    section Fase")
+        for i in range(elements):
+            lines.append(f"    Attività {seed}.{i} :a{i}, 2024-01-{(i % 28) + 1:02d}, 3d")
+    elif diagram_type == "pie":
+        lines.append(f"pie title Distribuzione {seed}")
+        for i in range(elements):
+            lines.append(f'    "Voce {i}" : {i + 1}')
+    else:
+        raise ValueError(f"Tipo di diagramma sconosciuto: {diagram_type}")
+    return "\n".join(lines)
+
+def generate_document(root_dir, chapters, diagrams_per_chapter, diagram_types, size):
+    """
+    Crea in root_dir un main.tex con `chapters` capitoli inclusi, ognuno con
+    `diagrams_per_chapter` diagrammi dei tipi indicati (a rotazione).
+    """
+    os.makedirs(os.path.join(root_dir, "chapters"), exist_ok=True)
+    elements = DIAGRAM_SIZES[size]
+    includes = []
+    seed = 0
+    for chapter in range(1, chapters + 1):
+        name = f"{chapter:02d}_capitolo"
+        includes.append(f"\\include{{chapters/{name}}}")
+        body = [f"\\chapter{{Capitolo {chapter}}}", ""]
+        for index in range(diagrams_per_chapter):
+            diagram_type = diagram_types[seed % len(diagram_types)]
+            body += [
+                f"\\section{{Sezione {chapter}.{index + 1}}}",
+                "Testo di esempio che precede il diagramma. " * 5,
+                "",
+                "```mermaid",
+                generate_diagram(diagram_type, elements, seed),
+                "```",
+                "",
+            ]
+            seed += 1
+        with open(os.path.join(root_dir, "chapters", name + ".tex"), 'w', encoding='utf-8') as f:
+            f.write("\n".join(body))
+
+    main = [
+        "\\documentclass[a4paper,12pt]{report}",
+        "\\usepackage[utf8]{inputenc}",
+        "\\usepackage{graphicx}",
+        "\\usepackage{float}",
+        "\\begin{document}",
+        "\\tableofcontents",
+        "\\clearpage",
+    ] + includes + ["\\end{document}", ""]
+    with open(os.path.join(root_dir, "main.tex"), 'w', encoding='utf-8') as f:
+        f.write("\n".join(main))
+    return seed
+
+def write_stubs(bin_dir):
+    """
+    Scrive gli stub di mmdc, pdflatex e del renderer batch in bin_dir.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, source in (("mmdc", STUB_MMDC), ("pdflatex", STUB_PDFLATEX), ("mermaid-batch-stub", STUB_BATCH_RENDERER)):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"#!{sys.executable}\n{source.lstrip()}")
+        os.chmod(path, 0o755)
+
+def unprocessed_tex_files(doc_dir):
+    """
+    File .tex della copia di build che contengono ancora blocchi Mermaid:
+    una pipeline che termina con successo ma lascia i blocchi non sostituiti
+    non misura la build reale.
+    """
+    project_copy = os.path.join(doc_dir, "temp_build", "project_copy")
+    leftovers = []
+    for dirpath, _, filenames in os.walk(project_copy):
+        for filename in filenames:
+            if filename.endswith(".tex"):
+                path = os.path.join(dirpath, filename)
+                with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                    if "```mermaid" in f.read():
+                        leftovers.append(os.path.relpath(path, project_copy))
+    return sorted(leftovers)
+
+def run_pipeline(doc_dir, bin_dir, pipeline_args, env_overrides, trace_path):
+    """
+    Esegue la pipeline una volta e restituisce le misure: tempo reale, tempo
+    CPU e picco di memoria del processo e dei suoi figli, fasi dal profilo,
+    più i file rimasti con blocchi Mermaid non sostituiti.
+    """
+    env = dict(os.environ)
+    env.update(env_overrides)
+    env["PATH"] = bin_dir + os.pathsep + env.get("PATH", "")
+    cmd = [sys.executable, PIPELINE_SCRIPT, "--profile", "--profile-output", trace_path] + pipeline_args
+
+    started = time.perf_counter()
+    process = subprocess.Popen(cmd, cwd=doc_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    phases = {}
+    counters = {}
+    if os.path.exists(trace_path):
+        with open(trace_path, 'r', encoding='utf-8') as f:
+            trace = json.load(f)
+        phases = trace.get("otherData", {}).get("summary", {})
+        counters = trace.get("otherData", {}).get("counters", {})
+
+    return {
+        "returncode": process.returncode,
+        "wall_time": wall_time,
+        "cpu_time": usage.ru_utime + usage.ru_stime,
+        # ru_maxrss è in KiB su Linux e in byte su macOS
+        "peak_rss_kb": usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss,
+        "phases": phases,
+        "counters": counters,
+        "unprocessed": unprocessed_tex_files(doc_dir),
+        "output_tail": output.decode('utf-8', 'replace').splitlines()[-5:],
+    }
+
+def aggregate(runs):
+    """
+    Riassume più esecuzioni con minimo e mediana di ogni metrica.
+    """
+    summary = {}
+    for metric in ("wall_time", "cpu_time", "peak_rss_kb"):
+        values = [run[metric] for run in runs]
+        summary[metric] = {"min": min(values), "median": statistics.median(values)}
+    phase_names = sorted({name for run in runs for name in run["phases"]})
+    summary["phases"] = {
+        name: statistics.median(run["phases"].get(name, {}).get("total", 0.0) for run in runs)
+        for name in phase_names
+    }
+    return summary
+
+def print_report(result, baseline=None):
+    summary = result["summary"]
+    print("\nRisultati del benchmark:")
+    for metric, label in (("wall_time", "Tempo reale (s)"), ("cpu_time", "Tempo CPU (s)"), ("peak_rss_kb", "Picco RSS (KiB)")):
+        line = f"  {label:<18} min {summary[metric]['min']:>10.2f}   mediana {summary[metric]['median']:>10.2f}"
+        if baseline is not None:
+            previous = baseline["summary"][metric]["median"]
+            if previous:
+                line += f"   ({(summary[metric]['median'] - previous) / previous * 100:+.1f}% rispetto al riferimento)"
+        print(line)
+    print("  Fasi (mediana del tempo totale, s):")
+    for name, total in sorted(summary["phases"].items(), key=lambda item: item[1], reverse=True):
+        line = f"    {name:<30} {total:>8.3f}"
+        if baseline is not None and name in baseline["summary"]["phases"]:
+            line += f"   (riferimento {baseline['summary']['phases'][name]:.3f})"
+        print(line)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark della pipeline di documentazione con mmdc e pdflatex simulati.",
+        epilog="Gli argomenti dopo -- vengono passati a luppoloabirra_latex.py; "
+               "{stub_batch} viene sostituito con il renderer batch simulato "
+               "(ad esempio: -- --renderer batch --renderer-cmd {stub_batch})."
+    )
+    parser.add_argument("--chapters", type=int, default=10, help="Numero di capitoli (default: %(default)s)")
+    parser.add_argument("--diagrams", type=int, default=5, help="Diagrammi per capitolo (default: %(default)s)")
+    parser.add_argument(
+        "--types", default=",".join(DIAGRAM_TYPES),
+        help=f"Tipi di diagramma separati da virgola tra {', '.join(DIAGRAM_TYPES)} (default: tutti)"
+    )
+    parser.add_argument("--size", choices=sorted(DIAGRAM_SIZES), default="medium", help="Dimensione dei diagrammi (default: %(default)s)")
+    parser.add_argument("--mmdc-latency", type=float, default=0.2, help="Latenza simulata di ogni chiamata mmdc in secondi (default: %(default)s)")
+    parser.add_argument("--batch-latency", type=float, default=0.05, help="Latenza simulata per diagramma del renderer batch (default: %(default)s)")
+    parser.add_argument("--latex-latency", type=float, default=0.3, help="Latenza simulata di ogni passaggio pdflatex (default: %(default)s)")
+    parser.add_argument("--latex-settle", type=int, default=2, help="Passaggi pdflatex necessari a stabilizzare i riferimenti (default: %(default)s)")
+    parser.add_argument("--runs", type=int, default=3, help="Numero di esecuzioni (default: %(default)s)")
+    parser.add_argument("--keep-cache", action="store_true", help="Non svuota cache e temp_build tra un'esecuzione e l'altra")
+    parser.add_argument("--work-dir", default=None, help="Directory in cui generare il documento (default: temporanea)")
+    parser.add_argument("--output", default=None, help="File JSON dei risultati (default: benchmark_results/<data>.json)")
+    parser.add_argument("--compare", default=None, help="File JSON di un benchmark precedente da usare come riferimento")
+    args, pipeline_args = parser.parse_known_args(argv)
+    if pipeline_args and pipeline_args[0] == "--":
+        pipeline_args = pipeline_args[1:]
+    args.pipeline_args = pipeline_args
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    diagram_types = [t.strip() for t in args.types.split(",") if t.strip()]
+    unknown = [t for t in diagram_types if t not in DIAGRAM_TYPES]
+    if unknown:
+        print(f"Tipi di diagramma sconosciuti: {', '.join(unknown)}")
+        return 1
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="luppolo_bench_")
+    doc_dir = os.path.join(work_dir, "doc")
+    bin_dir = os.path.join(work_dir, "bin")
+    if os.path.exists(doc_dir):
+        shutil.rmtree(doc_dir)
+    total_diagrams = generate_document(doc_dir, args.chapters, args.diagrams, diagram_types, args.size)
+    write_stubs(bin_dir)
+    print(f"Documento sintetico: {args.chapters} capitoli, {total_diagrams} diagrammi ({args.size}) in {doc_dir}")
+
+    # Il renderer batch simulato sostituisce lo script Node se richiesto
+    pipeline_args = [
+        arg.replace("{stub_batch}", os.path.join(bin_dir, "mermaid-batch-stub")) for arg in args.pipeline_args
+    ]
+    env_overrides = {
+        "BENCH_MMDC_LATENCY": str(args.mmdc_latency),
+        "BENCH_BATCH_LATENCY": str(args.batch_latency),
+        "BENCH_LATEX_LATENCY": str(args.latex_latency),
+        "BENCH_LATEX_SETTLE": str(args.latex_settle),
+    }
+
+    runs = []
+    for run_number in range(1, args.runs + 1):
+        if not args.keep_cache or run_number == 1:
+            for transient in ("temp_build", ".mermaid_cache"):
+                shutil.rmtree(os.path.join(doc_dir, transient), ignore_errors=True)
+        trace_path = os.path.join(work_dir, f"trace_{run_number}.json")
+        run = run_pipeline(doc_dir, bin_dir, pipeline_args, env_overrides, trace_path)
+        runs.append(run)
+        print(f"Esecuzione {run_number}/{args.runs}: {run['wall_time']:.2f}s reali, "
+              f"{run['cpu_time']:.2f}s CPU, {run['peak_rss_kb'] / 1024:.1f} MiB di picco")
+        if run["returncode"] != 0:
+            print("La pipeline è terminata con errore:")
+            for line in run["output_tail"]:
+                print(f"  {line}")
+        if run["unprocessed"]:
+            print(f"Blocchi Mermaid non sostituiti in: {', '.join(run['unprocessed'])}")
+
+    result = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {
+            "chapters": args.chapters,
+            "diagrams_per_chapter": args.diagrams,
+            "diagram_types": diagram_types,
+            "size": args.size,
+            "mmdc_latency": args.mmdc_latency,
+            "batch_latency": args.batch_latency,
+            "latex_latency": args.latex_latency,
+            "latex_settle": args.latex_settle,
+            "keep_cache": args.keep_cache,
+            "pipeline_args": args.pipeline_args,
+        },
+        "runs": runs,
+        "summary": aggregate(runs),
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    output = args.output or os.path.join(
+        SCRIPT_DIR, "benchmark_results", datetime.now().strftime("%Y%m%d_%H%M%S") + ".json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2)
+    print(f"\nRisultati salvati in {output}")
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0 if all(run["returncode"] == 0 and not run["unprocessed"] for run in runs) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,182 @@
 import os
 import re
+import signal
 import subprocess
 import hashlib
 import shutil
 import json
 import tempfile
+import argparse
+import asyncio
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import select
+import struct
+import sys
+import base64
+import shlex
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from contextlib import contextmanager
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import pypdf
+except ImportError:  # Facoltativo: per --parallel-chapters basta anche qpdf
+    pypdf = None
+
+try:
+    from PIL import Image, ImageChops
+except ImportError:  # Facoltativo: serve solo per --optimize-images
+    Image = None
+
+class BuildProfiler:
+    """
+    Raccoglie i tempi delle fasi della build e alcuni contatori (hit della
+    cache, byte copiati, ...). Quando è disattivato le fasi non registrano
+    nulla, così la strumentazione può restare sempre nel codice.
+    Il risultato si esporta in formato Chrome trace-event (chrome://tracing,
+    Perfetto) per confrontare build diverse.
+    Le fasi dei task asyncio concorrenti (render, capitoli) girano tutte sullo
+    stesso thread: per non sovrapporre intervalli non annidati sulla stessa
+    riga, ogni task riceve una corsia (tid sintetico) libera finché la sua
+    fase più esterna è aperta.
+    """
+    
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.origin = time.perf_counter()
+        self.events = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.task_lanes = {}
+        self.free_lanes = []
+        self.lane_count = 0
+    
+    def _acquire_lane(self, task):
+        with self.lock:
+            if task in self.task_lanes:
+                self.task_lanes[task][1] += 1
+                return self.task_lanes[task][0]
+            if self.free_lanes:
+                lane = self.free_lanes.pop(0)
+            else:
+                self.lane_count += 1
+                lane = self.lane_count
+                self.events.append({
+                    "name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": lane,
+                    "args": {"name": f"asyncio {lane}"},
+                })
+            self.task_lanes[task] = [lane, 1]
+            return lane
+    
+    def _release_lane(self, task):
+        with self.lock:
+            entry = self.task_lanes[task]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.task_lanes[task]
+                self.free_lanes.append(entry[0])
+                self.free_lanes.sort()
+    
+    @contextmanager
+    def phase(self, name, category="build", **args):
+        if not self.enabled:
+            yield
+            return
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:  # Nessun event loop in questo thread
+            task = None
+        tid = self._acquire_lane(task) if task is not None else threading.get_ident()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            finished = time.perf_counter()
+            if task is not None:
+                self._release_lane(task)
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (started - self.origin) * 1e6,
+                "dur": (finished - started) * 1e6,
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": args,
+            }
+            with self.lock:
+                self.events.append(event)
+    
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def summary(self):
+        """
+        Aggrega le fasi per nome: numero di occorrenze, tempo totale e massimo (in secondi).
+        """
+        rows = {}
+        for event in self.events:
+            if event["ph"] != "X":
+                continue
+            row = rows.setdefault(event["name"], {"count": 0, "total": 0.0, "max": 0.0})
+            duration = event["dur"] / 1e6
+            row["count"] += 1
+            row["total"] += duration
+            row["max"] = max(row["max"], duration)
+        return rows
+    
+    def print_summary(self):
+        rows = self.summary()
+        print("\nProfilo della build:")
+        print(f"  {'Fase':<32} {'N':>5} {'Totale (s)':>11} {'Medio (s)':>10} {'Max (s)':>9}")
+        for name, row in sorted(rows.items(), key=lambda item: item[1]["total"], reverse=True):
+            mean = row["total"] / row["count"]
+            print(f"  {name:<32} {row['count']:>5} {row['total']:>11.3f} {mean:>10.3f} {row['max']:>9.3f}")
+        for name, value in sorted(self.counters.items()):
+            print(f"  {name}: {value}")
+    
+    def write_trace(self, path):
+        """
+        Scrive la traccia in formato Chrome trace-event, con i contatori in otherData.
+        """
+        now = (time.perf_counter() - self.origin) * 1e6
+        trace_events = list(self.events)
+        for name, value in self.counters.items():
+            trace_events.append({
+                "name": name, "ph": "C", "ts": now, "pid": os.getpid(),
+                "tid": threading.get_ident(), "args": {"value": value},
+            })
+        trace = {
+            "traceEvents": trace_events,
+            "displayTimeUnit": "ms",
+            "otherData": {"counters": self.counters, "summary": self.summary()},
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f, indent=1)
+
+PROFILER = BuildProfiler()
+
+def copy_file_counted(src, dst):
+    """
+    Copia un file con shutil.copy2 registrando i byte copiati nel profilo.
+    """
+    shutil.copy2(src, dst)
+    PROFILER.count("bytes_copied", os.path.getsize(dst))
+    return dst
+
 def generate_filename(code, output_dir, extension='png'):
     """
     Genera un nome file univoco basato sull'hash del codice Mermaid.
@@ -14,19 +184,58 @@ def generate_filename(code, output_dir, extension='png'):
     code_hash = hashlib.md5(code.encode('utf-8')).hexdigest()
     return os.path.join(output_dir, f"mermaid_{code_hash}.{extension}")
 
+DIAGRAM_SCAN_PATTERN = re.compile(
+    r"(?P<header>^(?P<type>flowchart|sequenceDiagram|classDiagram|stateDiagram|gantt|pie|graph|erDiagram)"
+    r"(?:[ \t]+(?P<direction>LR|RL|TD|TB|BT)\b)?)"
+    r"|(?P<edge>-->|==>|---|===)"
+    r"|(?P<newline>\n)",
+    re.MULTILINE
+)
+
+_diagram_info_cache = {}
+_diagram_info_lock = threading.Lock()
+
+def classify_diagram(code):
+    """
+    Classifica un diagramma con una sola scansione del sorgente.
+    Restituisce un dizionario con hash, tipo, direzione (solo per flowchart
+    e graph, letta dalla riga di intestazione), numero di archi e di righe.
+    I risultati sono memorizzati per hash del contenuto per tutta la build.
+    """
+    code_hash = hashlib.md5(code.encode('utf-8')).hexdigest()
+    info = _diagram_info_cache.get(code_hash)
+    if info is not None:
+        return info
+    
+    info = {"hash": code_hash, "type": "generic", "direction": None, "edges": 0, "lines": 0}
+    for match in DIAGRAM_SCAN_PATTERN.finditer(code):
+        kind = match.lastgroup
+        if kind == "newline":
+            info["lines"] += 1
+        elif kind == "edge":
+            info["edges"] += 1
+        elif info["type"] == "generic":
+            # Conta solo la prima intestazione, come un diagramma Mermaid
+            info["type"] = match.group("type")
+            if info["type"] in ("flowchart", "graph"):
+                info["direction"] = match.group("direction")
+    
+    with _diagram_info_lock:
+        info = _diagram_info_cache.setdefault(code_hash, info)
+    PROFILER.count("diagrams_classified")
+    return info
+
 def get_diagram_type_and_dimensions(code):
     """
     Determina il tipo di diagramma e le dimensioni ottimali.
     Restituisce (tipo_diagramma, width_px, height_px, larghezza_tex, caption)
     """
-    # Estrai il tipo di diagramma
-    type_match = re.search(r'^(flowchart|sequenceDiagram|classDiagram|stateDiagram|gantt|pie|graph|erDiagram)', code.strip(), re.MULTILINE)
+    info = classify_diagram(code)
+    diagram_type = info["type"]
     
-    if not type_match:
+    if diagram_type == "generic":
         return "generic", 1600, 1200, "0.95\\textwidth", "Diagramma"
     
-    diagram_type = type_match.group(1)
-    
     # Estrai una possibile didascalia/titolo dal diagramma
     caption = "Diagramma"
     
@@ -38,16 +247,16 @@ def get_diagram_type_and_dimensions(code):
     height_px = 1200  # Base height (alta risoluzione)
     
     # Valuta la complessità del diagramma contando nodi/elementi
-    lines = code.count("\n")
-    elements = len(re.findall(r'(-->|==>|---|===)', code))
+    lines = info["lines"]
+    elements = info["edges"]
     
     # Regola dimensioni in base a tipo e complessità
     if diagram_type == "flowchart" or diagram_type == "graph":
-        if "LR" in code or "RL" in code:  # Orizzontale
+        if info["direction"] in ("LR", "RL"):  # Orizzontale
             width_px = 2000 if elements > 10 else 1800  
             height_px = 1000 if elements > 10 else 800
             width_tex = "1.0\\textwidth" if elements > 10 else "0.98\\textwidth"
-        elif "TD" in code or "BT" in code:  # Verticale
+        elif info["direction"] in ("TD", "TB", "BT"):  # Verticale
             width_px = 1500 if elements > 10 else 1300
             height_px = 1800 if elements > 10 else 1400
             width_tex = "0.9\\textwidth" if elements > 10 else "0.85\\textwidth"
@@ -70,10 +279,12 @@ def get_diagram_type_and_dimensions(code):
     
     return diagram_type, width_px, height_px, width_tex, caption
 
-def create_mermaid_config():
+def create_mermaid_config(html_labels=True):
     """
     Crea un file di configurazione temporaneo per Mermaid con margini
     minimi e ottimizzato per la leggibilità.
+    Con html_labels=False le etichette vengono emesse come testo SVG invece
+    che come foreignObject, che i convertitori SVG->PDF non sanno disegnare.
     """
     config = {
         "theme": "default",
@@ -153,127 +364,1055 @@ def create_mermaid_config():
         }
     }
     
+    if not html_labels:
+        config["htmlLabels"] = False
+        config["flowchart"]["htmlLabels"] = False
+    
     config_file = tempfile.NamedTemporaryFile(delete=False, suffix='.json')
     with open(config_file.name, 'w') as f:
         json.dump(config, f)
     
     return config_file.name
 
-def process_mermaid_blocks_in_content(tex_content, output_dir, base_dir):
+MERMAID_PATTERN = re.compile(r"```mermaid\s+(.*?)```", re.DOTALL)
+
+PLACEHOLDER_NOT_GENERATED = "\\begin{center}\\fbox{\\parbox{0.9\\textwidth}{\\centering Diagramma Mermaid non generato}}\\end{center}"
+PLACEHOLDER_ERROR = "\\begin{center}\\fbox{\\parbox{0.9\\textwidth}{\\centering Errore nella generazione del diagramma Mermaid}}\\end{center}"
+PLACEHOLDER_TIMEOUT = "\\begin{center}\\fbox{\\parbox{0.9\\textwidth}{\\centering Diagramma Mermaid non generato (tempo scaduto)}}\\end{center}"
+
+DEFAULT_CACHE_DIRNAME = ".mermaid_cache"
+DEFAULT_CACHE_SIZE_MB = 500
+# Dopo quanto tempo senza essere più incontrato un fallimento viene dimenticato
+FAILURE_TTL_SECONDS = 30 * 24 * 3600
+
+class DiagramCache:
     """
-    Cerca i blocchi di codice Mermaid e li converte in PNG ad alta qualità,
-    ottimizzati per occupare più spazio nella pagina.
+    Cache persistente dei diagrammi renderizzati, indirizzata per contenuto.
+    I file vivono fuori da temp_build e sopravvivono tra una build e l'altra;
+    un file index.json tiene traccia di dimensioni, ultimo utilizzo e
+    statistiche, e l'eccedenza rispetto a max_bytes viene rimossa in ordine LRU.
+    Lo stesso indice fa da cache negativa: i diagrammi che mmdc non riesce a
+    renderizzare restano in quarantena, con lo stderr catturato, finché il
+    sorgente o la versione del renderer non cambiano.
     """
-    pattern = re.compile(r"```mermaid\s+(.*?)```", re.DOTALL)
+    INDEX_FILENAME = "index.json"
     
-    # Assicurati che la directory di output esista
-    os.makedirs(output_dir, exist_ok=True)
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_SIZE_MB * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, self.INDEX_FILENAME)
+        self.lock = threading.Lock()
+        self.reset_stats()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._load_index()
     
-    # Conta il numero di diagrammi nel file
-    diagrams_count = len(pattern.findall(tex_content))
-    print(f"Trovati {diagrams_count} diagrammi mermaid da elaborare")
+    def reset_stats(self):
+        """
+        Azzera le statistiche della build corrente: una cache condivisa tra
+        più documenti o tra le ricostruzioni della modalità watch le riporta
+        per ciascuna build, non cumulate.
+        """
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.quarantined = 0
     
-    # Crea configurazione mermaid
-    config_file = create_mermaid_config()
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        index.setdefault("entries", {})
+        index.setdefault("failures", {})
+        index.setdefault("stats", {"hits": 0, "misses": 0, "evictions": 0})
+        # Scarta le voci il cui file è stato rimosso a mano
+        for key, entry in list(index["entries"].items()):
+            if not os.path.exists(os.path.join(self.cache_dir, entry["file"])):
+                del index["entries"][key]
+        return index
     
-    def repl(match):
-        code = match.group(1).strip()
-        
-        # Analizza il diagramma per determinare il tipo e le dimensioni ottimali
-        diagram_type, width_px, height_px, width_tex, caption = get_diagram_type_and_dimensions(code)
-        
-        # Genera i file temporanei
-        png_file = generate_filename(code, output_dir, extension="png")
-        temp_input = generate_filename(code, output_dir, extension="mmd")
-        
-        # Calcola il nome del file relativo senza percorso
-        png_filename = os.path.basename(png_file)
+    @staticmethod
+    def make_key(code, config_json, width_px, height_px, renderer_version, output_format="png"):
+        """
+        Calcola la chiave di cache: sorgente, configurazione Mermaid, dimensioni,
+        versione di mmdc e formato richiesto concorrono tutte al risultato del render.
+        """
+        digest = hashlib.sha256()
+        for part in (code, config_json, str(width_px), str(height_px), renderer_version or "", output_format):
+            digest.update(part.encode('utf-8'))
+            digest.update(b"\0")
+        return digest.hexdigest()
+    
+    def get(self, key, dest_stem):
+        """
+        Copia il file associato a key in dest_stem più l'estensione del file
+        in cache (un render "auto" può produrre PNG o PDF).
+        Restituisce il percorso copiato in caso di hit, None altrimenti.
+        """
+        with self.lock:
+            entry = self.index["entries"].get(key)
+            if entry is None:
+                self.misses += 1
+                self.index["stats"]["misses"] += 1
+                PROFILER.count("cache_misses")
+                return None
+            cached_file = os.path.join(self.cache_dir, entry["file"])
+            dest_path = dest_stem.rstrip(".") + os.path.splitext(entry["file"])[1]
+            try:
+                shutil.copyfile(cached_file, dest_path)
+            except OSError:
+                del self.index["entries"][key]
+                self.misses += 1
+                self.index["stats"]["misses"] += 1
+                PROFILER.count("cache_misses")
+                return None
+            entry["last_used"] = time.time()
+            self.hits += 1
+            self.index["stats"]["hits"] += 1
+            PROFILER.count("cache_hits")
+            return dest_path
+    
+    def put(self, key, src_path):
+        """
+        Salva in cache una copia di src_path sotto la chiave key.
+        """
+        extension = os.path.splitext(src_path)[1]
+        filename = f"{key}{extension}"
+        cached_file = os.path.join(self.cache_dir, filename)
+        temp_file = cached_file + ".tmp"
+        shutil.copyfile(src_path, temp_file)
+        os.replace(temp_file, cached_file)
+        now = time.time()
+        with self.lock:
+            self.index["entries"][key] = {
+                "file": filename,
+                "size": os.path.getsize(cached_file),
+                "created": now,
+                "last_used": now,
+            }
+            self._evict()
+    
+    @staticmethod
+    def failure_key(code, renderer_version, backend):
+        """
+        Chiave della cache negativa: un fallimento dipende dal sorgente, dalla
+        versione di mmdc e dal backend di render che l'ha prodotto.
+        """
+        digest = hashlib.sha256()
+        for part in (code, renderer_version or "", backend or ""):
+            digest.update(part.encode('utf-8'))
+            digest.update(b"\0")
+        return digest.hexdigest()
+    
+    def lookup_failure(self, code, renderer_version, backend):
+        """
+        Restituisce lo stderr del render fallito registrato per il diagramma,
+        oppure None se il diagramma non è in quarantena.
+        """
+        with self.lock:
+            entry = self.index["failures"].get(self.failure_key(code, renderer_version, backend))
+            return entry["error"] if entry is not None else None
+    
+    def get_failure(self, code, renderer_version, backend):
+        """
+        Come lookup_failure, ma conta il diagramma come saltato in questa build.
+        """
+        with self.lock:
+            entry = self.index["failures"].get(self.failure_key(code, renderer_version, backend))
+            if entry is None:
+                return None
+            entry["last_seen"] = time.time()
+            self.quarantined += 1
+            PROFILER.count("quarantined_diagrams")
+            return entry["error"]
+    
+    def put_failure(self, code, renderer_version, backend, error):
+        """
+        Mette in quarantena un diagramma che non è stato possibile renderizzare.
+        """
+        now = time.time()
+        with self.lock:
+            self.index["failures"][self.failure_key(code, renderer_version, backend)] = {
+                "hash": hashlib.md5(code.encode('utf-8')).hexdigest(),
+                "renderer_version": renderer_version,
+                "backend": backend,
+                "error": error,
+                "failed_at": now,
+                "last_seen": now,
+            }
+    
+    def quarantined_hashes(self, renderer_version, backend):
+        """
+        Hash MD5 dei sorgenti in quarantena per questa versione di mmdc e
+        questo backend, nello stesso formato del manifest della build.
+        """
+        with self.lock:
+            return {
+                entry["hash"] for entry in self.index["failures"].values()
+                if entry["renderer_version"] == renderer_version and entry.get("backend") == backend
+            }
+    
+    def clear_failure(self, code, renderer_version, backend):
+        with self.lock:
+            self.index["failures"].pop(self.failure_key(code, renderer_version, backend), None)
+    
+    def total_size(self):
+        return sum(entry["size"] for entry in self.index["entries"].values())
+    
+    def _evict(self):
+        total = self.total_size()
+        if total <= self.max_bytes:
+            return
+        # Rimuove prima le voci usate meno di recente
+        by_age = sorted(self.index["entries"].items(), key=lambda item: item[1]["last_used"])
+        for key, entry in by_age:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, entry["file"]))
+            except OSError:
+                pass
+            del self.index["entries"][key]
+            total -= entry["size"]
+            self.evictions += 1
+            self.index["stats"]["evictions"] += 1
+    
+    def save(self):
+        """
+        Scrive l'indice su disco in modo atomico.
+        """
+        with self.lock:
+            # I fallimenti di sorgenti non più incontrati da tempo sono obsoleti
+            expired = time.time() - FAILURE_TTL_SECONDS
+            self.index["failures"] = {
+                key: entry for key, entry in self.index["failures"].items() if entry["last_seen"] >= expired
+            }
+            temp_path = self.index_path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.index, f, indent=2)
+            os.replace(temp_path, self.index_path)
+    
+    def print_stats(self):
+        entries = len(self.index["entries"])
+        size_mb = self.total_size() / (1024 * 1024)
+        print(f"Cache diagrammi: {self.hits} hit, {self.misses} miss, {self.evictions} rimossi "
+              f"({entries} voci, {size_mb:.1f} MB in {self.cache_dir})")
+        if self.quarantined or self.index["failures"]:
+            print(f"Diagrammi in quarantena: {self.quarantined} saltati in questa build, "
+                  f"{len(self.index['failures'])} registrati")
+
+def default_jobs():
+    """
+    Numero predefinito di render mmdc concorrenti: ogni processo avvia un
+    Chromium headless, quindi il valore resta limitato anche su macchine grandi.
+    """
+    return max(1, min(4, os.cpu_count() or 1))
+
+DEFAULT_RENDER_TIMEOUT = 120
+DEFAULT_RENDER_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_LATEX_TIMEOUT = 600
+DEFAULT_TOOL_TIMEOUT = 120
+DEFAULT_BATCH_STARTUP_TIMEOUT = 60
+
+# Processi esterni in corso in qualunque thread, per poterli terminare tutti con Ctrl-C
+_running_processes = set()
+_running_lock = threading.Lock()
+_shutting_down = threading.Event()
+
+def kill_process_tree(process):
+    """
+    Termina un processo avviato in una nuova sessione insieme ai suoi figli
+    (per mmdc anche il Chromium headless che ha lanciato).
+    """
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+async def run_command_async(cmd, timeout=None, cwd=None, on_line=None, env=None):
+    """
+    Esegue un comando esterno come sottoprocesso asyncio.
+    Se supera `timeout` secondi, o se il task viene cancellato (Ctrl-C), il
+    processo e i suoi figli vengono terminati.
+    Con on_line lo stdout non viene accumulato ma passato riga per riga alla
+    callback mentre il processo gira; se la callback restituisce True il
+    processo viene interrotto (aborted).
+    Restituisce un dizionario con returncode, stdout, stderr, timed_out,
+    aborted e durata.
+    """
+    if _shutting_down.is_set():
+        raise asyncio.CancelledError("build interrotta")
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        *cmd, cwd=cwd, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        start_new_session=True, limit=1024 * 1024
+    )
+    with _running_lock:
+        _running_processes.add(process)
+    timed_out = False
+    aborted = False
+    stdout, stderr = b"", b""
+    
+    async def stream_stdout():
+        nonlocal aborted
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            if not aborted and on_line(line.decode('utf-8', 'replace').rstrip("\r\n")):
+                aborted = True
+                kill_process_tree(process)
+    
+    async def collect():
+        if on_line is None:
+            return await process.communicate()
+        _, err = await asyncio.gather(stream_stdout(), process.stderr.read())
+        await process.wait()
+        return b"", err
+    
+    try:
+        stdout, stderr = await asyncio.wait_for(collect(), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        kill_process_tree(process)
+        await process.wait()
+    except asyncio.CancelledError:
+        kill_process_tree(process)
+        await process.wait()
+        raise
+    finally:
+        with _running_lock:
+            _running_processes.discard(process)
+    return {
+        "cmd": cmd,
+        "returncode": process.returncode,
+        "stdout": stdout.decode('utf-8', 'replace'),
+        "stderr": stderr.decode('utf-8', 'replace'),
+        "timed_out": timed_out,
+        "aborted": aborted,
+        "duration": time.perf_counter() - started,
+    }
+
+def terminate_running_processes():
+    """
+    Termina i processi esterni in corso in tutti i thread e impedisce di
+    avviarne di nuovi: serve quando Ctrl-C arriva mentre dei thread di lavoro
+    (che asyncio non può cancellare) stanno eseguendo pdflatex.
+    """
+    _shutting_down.set()
+    with _running_lock:
+        processes = list(_running_processes)
+    for process in processes:
+        kill_process_tree(process)
+
+def run_command(cmd, timeout=None, cwd=None, on_line=None, env=None):
+    """
+    Versione bloccante di run_command_async, per i passaggi sequenziali.
+    """
+    return asyncio.run(run_command_async(cmd, timeout=timeout, cwd=cwd, on_line=on_line, env=env))
+
+def run_checked(cmd, timeout=DEFAULT_TOOL_TIMEOUT, cwd=None):
+    """
+    Come run_command, ma solleva CalledProcessError se il comando fallisce
+    o supera il timeout.
+    """
+    result = run_command(cmd, timeout=timeout, cwd=cwd)
+    if result["returncode"] != 0 or result["timed_out"]:
+        raise subprocess.CalledProcessError(result["returncode"], cmd, result["stdout"], result["stderr"])
+    return result
+
+class SubprocessRenderer:
+    """
+    Backend di render che lancia un processo mmdc per ogni diagramma.
+    È il comportamento storico e resta il fallback quando il renderer batch
+    non è disponibile.
+    """
+    name = "subprocess"
+    
+    async def render(self, code, input_file, output_file, config_file=None, width_px=None, height_px=None, timeout=None):
+        """
+        Renderizza un diagramma in output_file; il formato (png, svg, pdf)
+        segue l'estensione del file.
+        Restituisce un dizionario con ok, error, timed_out e diagram_error
+        (vero solo se mmdc è terminato con un errore sul diagramma).
+        """
+        cmd = [
+            "mmdc", 
+            "-i", input_file, 
+            "-o", output_file, 
+            "-b", "white"       # Sfondo bianco per migliore contrasto
+        ]
+        if config_file:
+            cmd += ["-c", config_file]
+        if width_px and height_px:
+            cmd += ["-w", str(width_px), "-H", str(height_px)]
+        if output_file.endswith(".pdf"):
+            cmd.append("--pdfFit")  # Pagina ritagliata sulle dimensioni del diagramma
         
-        # Salva il codice in un file temporaneo .mmd
-        with open(temp_input, 'w', encoding='utf-8') as temp_f:
-            temp_f.write(code)
-            
-        print(f"Generazione {diagram_type} in PNG ottimizzato: {png_filename}")
+        result = await run_command_async(cmd, timeout=timeout)
+        if result["timed_out"]:
+            return {"ok": False, "error": f"mmdc interrotto dopo {timeout}s", "timed_out": True, "diagram_error": False}
+        if result["returncode"] != 0 or not os.path.exists(output_file):
+            error = result["stderr"] or result["stdout"] or f"mmdc terminato con codice {result['returncode']}"
+            # Solo un'uscita con errore e messaggio su stderr indica un diagramma non valido;
+            # un processo ucciso da un segnale o senza output non dice nulla sul sorgente
+            diagram_error = result["returncode"] > 0 and bool(result["stderr"].strip())
+            return {"ok": False, "error": error.strip(), "timed_out": False, "diagram_error": diagram_error}
+        return {"ok": True, "error": "", "timed_out": False, "diagram_error": False}
+    
+    def close(self):
+        pass
+
+class BatchRenderer:
+    """
+    Backend di render che mantiene attivo un unico processo Node/Puppeteer per
+    tutta la build. Appena pronto il processo scrive su stdout la riga
+    {"ready": true}; poi le richieste viaggiano su stdin come righe JSON
+    {"id", "source", "config", "width", "height", "background", "format"} e le
+    risposte tornano su stdout come {"id", "ok", "data" (base64), "error"}.
+    Qualsiasi processo che rispetti questo protocollo può sostituire lo script
+    Node, ad esempio un renderer finto per i test.
+    Se il processo termina durante la build, le richieste successive (e quelle
+    rimaste senza risposta) ripiegano su SubprocessRenderer. Una richiesta
+    scaduta fa terminare il processo (con il suo Chromium): un browser bloccato
+    non deve far scadere anche tutti i diagrammi successivi.
+    """
+    name = "batch"
+    DEFAULT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mermaid_batch_renderer.mjs")
+    
+    def __init__(self, command=None, startup_timeout=DEFAULT_BATCH_STARTUP_TIMEOUT):
+        self.command = command or ["node", self.DEFAULT_SCRIPT]
+        self.process = subprocess.Popen(
+            self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, text=True, encoding='utf-8', bufsize=1,
+            start_new_session=True
+        )
+        with _running_lock:
+            _running_processes.add(self.process)
+        self.write_lock = threading.Lock()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.next_id = 0
+        self.configs = {}
+        self.stderr_tail = []
+        self.ready = threading.Event()
+        self.exited = False
+        self.fallback = None
+        self.fallback_lock = threading.Lock()
+        self.reader = threading.Thread(target=self._read_responses, daemon=True)
+        self.reader.start()
+        threading.Thread(target=self._read_stderr, daemon=True).start()
         
+        # Node può partire e fallire subito dopo (ad esempio sull'import di
+        # puppeteer): il renderer è valido solo dopo la riga di "ready"
+        if not self.ready.wait(startup_timeout) or self.exited:
+            reason = "terminato all'avvio" if self.exited else f"non pronto dopo {startup_timeout}s"
+            self.close(timeout=1)
+            if self.stderr_tail:
+                reason += ": " + " | ".join(self.stderr_tail[-3:])
+            raise RuntimeError(f"renderer batch {reason}")
+    
+    def _read_responses(self):
+        for line in self.process.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                response = json.loads(line)
+            except ValueError:
+                continue
+            if response.get("ready"):
+                self.ready.set()
+                continue
+            with self.pending_lock:
+                future = self.pending.pop(response.get("id"), None)
+            if future is not None:
+                self._resolve(future, response)
+        # Il processo è terminato: sblocca l'avvio e le richieste ancora in attesa,
+        # che ripiegano su SubprocessRenderer
+        with self.pending_lock:
+            self.exited = True
+            pending, self.pending = self.pending, {}
+        self.ready.set()
+        message = "renderer batch terminato inaspettatamente"
+        if self.stderr_tail:
+            message += ": " + " | ".join(self.stderr_tail[-3:])
+        for future in pending.values():
+            self._resolve(future, {"ok": False, "error": message, "exited": True})
+    
+    @staticmethod
+    def _resolve(future, response):
+        # La richiesta può essere già stata abbandonata per timeout o Ctrl-C
         try:
-            # Genera PNG con margini minimi e alta risoluzione
-            cmd = [
-                "mmdc", 
-                "-i", temp_input, 
-                "-o", png_file, 
-                "-b", "white",      # Sfondo bianco per migliore contrasto
-                "-c", config_file,
-                "-w", str(width_px),
-                "-H", str(height_px)
-            ]
-            
-            result = subprocess.run(cmd, check=False, capture_output=True, text=True)
-            
-            if result.returncode != 0 or not os.path.exists(png_file):
-                print("Primo tentativo fallito, riprovo con impostazioni alternative...")
-                # Riprova con diverse impostazioni
-                retry_cmd = [
-                    "mmdc", 
-                    "-i", temp_input, 
-                    "-o", png_file,
-                    "-b", "white"
-                ]
-                retry_result = subprocess.run(retry_cmd, check=False, capture_output=True, text=True)
-                
-                if retry_result.returncode != 0 or not os.path.exists(png_file):
-                    print(f"Tutti i tentativi falliti per {png_filename}")
-                    return "\\begin{center}\\fbox{\\parbox{0.9\\textwidth}{\\centering Diagramma Mermaid non generato}}\\end{center}"
-                else:
-                    print(f"Generazione riuscita con impostazioni alternative per {png_filename}")
-            
-            # Calcola il percorso relativo dell'immagine
-            relative_path = os.path.relpath(png_file, base_dir)
-            
-            # Pulisci i file temporanei
-            if os.path.exists(temp_input):
-                os.remove(temp_input)
-            
-            # Adatta le opzioni di posizionamento in base al tipo di diagramma
-            # Qui usiamo sempre [H] per flowchart e altri diagrammi che hanno bisogno
-            # di stare esattamente nel contesto, ma [!htb] per sequence diagram che
-            # possono richiedere più spazio
-            placement_option = "H"  # Default: qui esattamente
-            if diagram_type in ["sequenceDiagram", "classDiagram"] and diagrams_count > 3:
-                placement_option = "!htb"  # Più flessibile per diagrammi complessi, priorità maggiore
-            
-            # Costruisci l'ambiente figure ottimizzato per massimizzare lo spazio disponibile
-            # Rimuoviamo l'opzione keepaspectratio per permettere alla figura di espandersi
-            # fino alla dimensione specificata
-            figure_env = f"""
-\\begin{{figure}}[{placement_option}]
-  \\centering
-  \\setlength{{\\fboxsep}}{{1pt}}%
-  \\includegraphics[width={width_tex}]{{{relative_path}}}
-  \\caption{{{caption}}}
-\\end{{figure}}
-"""
-            return figure_env.strip()
-        except Exception as e:
-            print(f"Eccezione nella generazione del diagramma: {str(e)}")
-            return "\\begin{center}\\fbox{\\parbox{0.9\\textwidth}{\\centering Errore nella generazione del diagramma Mermaid}}\\end{center}"
+            future.set_result(response)
+        except InvalidStateError:
+            pass
+    
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            self.stderr_tail = (self.stderr_tail + [line.strip()])[-20:]
     
-    # Sostituisci tutti i blocchi mermaid
-    result = pattern.sub(repl, tex_content)
+    def _load_config(self, config_file):
+        if not config_file:
+            return None
+        if config_file not in self.configs:
+            with open(config_file, 'r') as f:
+                self.configs[config_file] = json.load(f)
+        return self.configs[config_file]
     
-    # Pulisci il file di configurazione
-    if os.path.exists(config_file):
-        os.remove(config_file)
+    def _fallback_renderer(self):
+        with self.fallback_lock:
+            if self.fallback is None:
+                message = "Renderer batch terminato, uso mmdc per i diagrammi rimanenti."
+                if self.stderr_tail:
+                    message += f" ({self.stderr_tail[-1]})"
+                print(message)
+                self.fallback = SubprocessRenderer()
+            return self.fallback
+    
+    async def render(self, code, input_file, output_file, config_file=None, width_px=None, height_px=None, timeout=None):
+        """
+        Invia un diagramma al processo batch e scrive l'immagine ricevuta in
+        output_file, nel formato indicato dalla sua estensione.
+        Restituisce un dizionario con ok, error, timed_out e diagram_error
+        (vero solo per un errore riportato dal processo batch ancora attivo).
+        """
+        args = (code, input_file, output_file, config_file, width_px, height_px, timeout)
+        future = Future()
+        with self.pending_lock:
+            if self.exited:
+                future = None
+            self.next_id += 1
+            request_id = self.next_id
+            if future is not None:
+                self.pending[request_id] = future
+        if future is None:
+            return await self._fallback_renderer().render(*args)
+        request = {
+            "id": request_id,
+            "source": code,
+            "config": self._load_config(config_file),
+            "width": width_px,
+            "height": height_px,
+            "background": "white",
+            "format": os.path.splitext(output_file)[1].lstrip(".") or "png",
+        }
+        try:
+            with self.write_lock:
+                self.process.stdin.write(json.dumps(request) + "\n")
+                self.process.stdin.flush()
+        except (OSError, ValueError):
+            # Pipe chiusa: il processo è terminato tra una richiesta e l'altra
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            return await self._fallback_renderer().render(*args)
         
+        try:
+            response = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            print(f"Renderer batch senza risposta dopo {timeout}s: lo termino.")
+            with self.pending_lock:
+                self.exited = True
+            kill_process_tree(self.process)
+            return {"ok": False, "error": f"renderer batch senza risposta dopo {timeout}s", "timed_out": True,
+                    "diagram_error": False}
+        finally:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+        if response.get("exited"):
+            return await self._fallback_renderer().render(*args)
+        if not response.get("ok"):
+            return {"ok": False, "error": response.get("error") or "errore sconosciuto del renderer batch", "timed_out": False,
+                    "diagram_error": True}
+        with open(output_file, 'wb') as f:
+            f.write(base64.b64decode(response["data"]))
+        return {"ok": True, "error": "", "timed_out": False, "diagram_error": False}
+    
+    def close(self, timeout=10):
+        """
+        Chiude stdin e attende la terminazione del processo batch.
+        """
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_tree(self.process)
+            self.process.wait()
+        with _running_lock:
+            _running_processes.discard(self.process)
+
+def create_renderer(backend, command=None):
+    """
+    Crea il backend di render richiesto. Se il renderer batch non si avvia
+    (comando assente, oppure processo che termina o non segnala di essere
+    pronto) si ripiega sul backend a processi mmdc separati.
+    """
+    if backend == BatchRenderer.name:
+        try:
+            renderer = BatchRenderer(command)
+            print(f"Renderer batch avviato: {' '.join(renderer.command)}")
+            return renderer
+        except (OSError, RuntimeError) as e:
+            print(f"Impossibile avviare il renderer batch ({str(e)}), uso mmdc per ogni diagramma.")
+    return SubprocessRenderer()
+
+DIAGRAM_FORMATS = ("png", "pdf", "svg", "auto")
+# Stima prudente dei byte per pixel di un PNG di diagramma (ampie aree uniformi)
+AUTO_PNG_BYTES_PER_PIXEL = 0.08
+SVG_VIEWBOX_PATTERN = re.compile(r'viewBox="\s*[-\d.]+[\s,]+[-\d.]+[\s,]+([\d.]+)[\s,]+([\d.]+)\s*"')
+
+def find_svg_converter():
+    """
+    Restituisce il comando per convertire un SVG in PDF (rsvg-convert o
+    Inkscape), oppure None se nessuno dei due è disponibile.
+    """
+    if shutil.which("rsvg-convert"):
+        return lambda svg, pdf: ["rsvg-convert", "-f", "pdf", "-o", pdf, svg]
+    if shutil.which("inkscape"):
+        return lambda svg, pdf: ["inkscape", svg, "--export-type=pdf", f"--export-filename={pdf}"]
+    return None
+
+async def convert_svg_to_pdf(svg_file, pdf_file, timeout=DEFAULT_TOOL_TIMEOUT):
+    """
+    Converte un SVG in PDF vettoriale includibile da pdflatex.
+    Restituisce True se la conversione è riuscita.
+    """
+    converter = find_svg_converter()
+    if converter is None:
+        return False
+    with PROFILER.phase("svg_to_pdf", category="render", diagram=os.path.basename(svg_file)):
+        result = await run_command_async(converter(svg_file, pdf_file), timeout=timeout)
+    return result["returncode"] == 0 and not result["timed_out"] and os.path.exists(pdf_file)
+
+def svg_dimensions(svg_file):
+    """
+    Legge larghezza e altezza intrinseche di un SVG dal suo viewBox.
+    """
+    with open(svg_file, 'r', encoding='utf-8', errors='replace') as f:
+        match = SVG_VIEWBOX_PATTERN.search(f.read(4096))
+    if not match:
+        return None
+    return float(match.group(1)), float(match.group(2))
+
+def choose_auto_format(svg_file, width_px):
+    """
+    Politica "auto": confronta la dimensione dell'SVG renderizzato con quella
+    stimata del PNG che si otterrebbe alla larghezza width_px, mantenendo le
+    proporzioni reali del diagramma. Sceglie il vettoriale quando pesa meno.
+    """
+    dimensions = svg_dimensions(svg_file)
+    if not dimensions or dimensions[0] <= 0:
+        return "png"
+    svg_width, svg_height = dimensions
+    png_height = svg_height * width_px / svg_width
+    estimated_png_bytes = width_px * png_height * AUTO_PNG_BYTES_PER_PIXEL
+    return "pdf" if os.path.getsize(svg_file) <= estimated_png_bytes else "png"
+
+def new_render_policy(timeout=DEFAULT_RENDER_TIMEOUT, retries=DEFAULT_RENDER_RETRIES, backoff=DEFAULT_RETRY_BACKOFF):
+    """
+    Parametri dei render: timeout di ogni tentativo (secondi, None per
+    nessun limite), numero di nuovi tentativi e attesa iniziale tra i
+    tentativi, che raddoppia a ogni fallimento.
+    """
+    return {"timeout": timeout, "retries": retries, "backoff": backoff}
+
+def new_render_result(image=None, error="", timed_out=False, attempts=0, exception=None, quarantined=False,
+                      diagram_error=False):
+    return {
+        "image": image, "error": error, "timed_out": timed_out, "attempts": attempts,
+        "exception": exception, "quarantined": quarantined, "diagram_error": diagram_error,
+    }
+
+async def render_with_retry(renderer, code, temp_input, output_file, config_file, width_px, height_px, policy=None):
+    """
+    Primo tentativo con configurazione e dimensioni ottimizzate, i successivi
+    con le impostazioni predefinite di mmdc dopo un'attesa crescente.
+    Restituisce il risultato strutturato dell'ultimo tentativo.
+    """
+    policy = policy or new_render_policy()
+    output_filename = os.path.basename(output_file)
+    total_attempts = 1 + max(0, policy["retries"])
+    
+    for attempt in range(1, total_attempts + 1):
+        if attempt > 1:
+            delay = policy["backoff"] * 2 ** (attempt - 2)
+            reason = outcome["error"].splitlines()[0] if outcome["error"] else "errore sconosciuto"
+            print(f"Tentativo {attempt - 1} fallito per {output_filename} ({reason}), "
+                  f"riprovo tra {delay:.1f}s con impostazioni alternative...")
+            await asyncio.sleep(delay)
+        optimized = attempt == 1
+        with PROFILER.phase("mmdc", category="render", diagram=output_filename, attempt=attempt, backend=renderer.name):
+            outcome = await renderer.render(
+                code, temp_input, output_file,
+                config_file if optimized else None,
+                width_px if optimized else None,
+                height_px if optimized else None,
+                timeout=policy["timeout"]
+            )
+        PROFILER.count("mmdc_calls")
+        if outcome["timed_out"]:
+            PROFILER.count("render_timeouts")
+        if outcome["ok"]:
+            if attempt > 1:
+                print(f"Generazione riuscita con impostazioni alternative per {output_filename}")
+            return new_render_result(output_file, attempts=attempt)
+    
+    print(f"Tutti i tentativi falliti per {output_filename}")
+    return new_render_result(
+        error=outcome["error"], timed_out=outcome["timed_out"], attempts=total_attempts,
+        diagram_error=outcome["diagram_error"]
+    )
+
+async def render_mermaid_diagram(code, output_dir, config_file, renderer=None, diagram_format="png", svg_config_file=None,
+                                 policy=None):
+    """
+    Renderizza un singolo diagramma, con nuovi tentativi a impostazioni
+    ridotte in caso di fallimento.
+    Il formato può essere png, pdf (PDF nativo di mmdc), svg (convertito una
+    volta in PDF) oppure auto, che sceglie per ogni diagramma in base alla
+    dimensione del render.
+    Restituisce un risultato strutturato (new_render_result) con il percorso
+    dell'immagine generata, oppure l'errore dell'ultimo tentativo.
+    """
+    if renderer is None:
+        renderer = SubprocessRenderer()
+    diagram_type, width_px, height_px, _, _ = get_diagram_type_and_dimensions(code)
+    
+    # Genera i file temporanei
+    temp_input = generate_filename(code, output_dir, extension="mmd")
+    
+    # Salva il codice in un file temporaneo .mmd
+    with open(temp_input, 'w', encoding='utf-8') as temp_f:
+        temp_f.write(code)
+    
+    result = None
+    if diagram_format in ("svg", "auto"):
+        svg_file = generate_filename(code, output_dir, extension="svg")
+        pdf_file = generate_filename(code, output_dir, extension="pdf")
+        print(f"Generazione {diagram_type} in SVG: {os.path.basename(svg_file)}")
+        svg_result = await render_with_retry(
+            renderer, code, temp_input, svg_file, svg_config_file or config_file, width_px, height_px, policy
+        )
+        if svg_result["image"] is not None:
+            chosen = "pdf" if diagram_format == "svg" else choose_auto_format(svg_file, width_px)
+            if diagram_format == "auto":
+                print(f"Formato scelto per {os.path.basename(svg_file)}: {chosen.upper()}")
+            if chosen == "pdf" and await convert_svg_to_pdf(svg_file, pdf_file):
+                result = new_render_result(pdf_file, attempts=svg_result["attempts"])
+            elif chosen == "pdf":
+                # Nessun convertitore SVG disponibile: PDF nativo di mmdc
+                diagram_format = "pdf"
+            else:
+                diagram_format = "png"
+            os.remove(svg_file)
+        elif diagram_format == "auto":
+            diagram_format = "png"
+        else:
+            result = svg_result
+    
+    if result is None:
+        output_file = generate_filename(code, output_dir, extension=diagram_format)
+        label = "PNG ottimizzato" if diagram_format == "png" else "PDF vettoriale"
+        print(f"Generazione {diagram_type} in {label}: {os.path.basename(output_file)}")
+        result = await render_with_retry(
+            renderer, code, temp_input, output_file, config_file, width_px, height_px, policy
+        )
+        if result["image"] is None:
+            return result
+    
+    # Pulisci i file temporanei
+    if result["image"] is not None and os.path.exists(temp_input):
+        os.remove(temp_input)
+    
     return result
 
-def modify_preamble(main_tex_path):
+def find_tex_files(root_dir):
     """
-    Modifica il preambolo del file LaTeX per ottimizzare il layout
-    e massimizzare lo spazio disponibile per le figure.
+    Restituisce i percorsi di tutti i file .tex sotto root_dir.
     """
-    with open(main_tex_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+    tex_files = []
+    for dirpath, _, filenames in os.walk(root_dir):
+        for filename in filenames:
+            if filename.endswith(".tex"):
+                tex_files.append(os.path.join(dirpath, filename))
+    return tex_files
+
+def diagram_metadata(root_dir, files=None):
+    """
+    Restituisce i metadati dei diagrammi Mermaid unici di root_dir senza
+    renderizzarli: classificazione, dimensioni scelte e file in cui compaiono.
+    """
+    if files is None:
+        files = [
+            os.path.join(root_dir, rel_path)
+            for rel_path in iter_stage_files(root_dir, ["*.tex"], DEFAULT_STAGE_EXCLUDES)
+        ]
+    index = build_diagram_index(files)
+    occurrences = {}
+    for file_path, codes in index.items():
+        for code in codes:
+            occurrences.setdefault(code, []).append(os.path.relpath(file_path, root_dir))
+    
+    metadata = []
+    for code in unique_diagrams(index):
+        _, width_px, height_px, width_tex, caption = get_diagram_type_and_dimensions(code)
+        entry = dict(classify_diagram(code))
+        entry.update({
+            "width_px": width_px,
+            "height_px": height_px,
+            "width_tex": width_tex,
+            "caption": caption,
+            "files": occurrences[code],
+        })
+        metadata.append(entry)
+    return metadata
+
+def render_diagrams_parallel(codes, output_dir, config_file, jobs=1, cache=None, renderer_version="", renderer=None,
+                             diagram_format="png", svg_config_file=None, policy=None, retry_failed=False):
+    """
+    Renderizza i diagrammi come task asyncio, con al massimo `jobs` render
+    contemporanei. Restituisce un dizionario codice -> risultato strutturato
+    (new_render_result): "image" è None se tutti i tentativi sono falliti,
+    "timed_out" indica se l'ultimo è scaduto ed "exception" è valorizzata se il
+    render ha sollevato un errore inatteso.
+    Se è indicata una DiagramCache, i diagrammi già noti vengono copiati
+    dalla cache senza invocare mmdc, e quelli falliti in una build precedente
+    passano direttamente al segnaposto (salvo retry_failed). In quarantena
+    finiscono solo gli errori sul diagramma riportati da un renderer
+    funzionante (diagram_error): timeout, errori di trasporto (pipe chiusa,
+    renderer terminato) ed eccezioni inattese possono essere transitori o
+    dipendere dal renderer, non dal sorgente.
+    Con Ctrl-C i render in corso vengono cancellati e i processi terminati.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    
+    config_json = ""
+    if cache is not None:
+        with open(config_file, 'r') as f:
+            config_json = f.read()
+    
+    backend = renderer.name if renderer is not None else SubprocessRenderer.name
+    
+    async def render(code, semaphore):
+        async with semaphore:
+            try:
+                cache_key = None
+                if cache is not None:
+                    error = None if retry_failed else cache.get_failure(code, renderer_version, backend)
+                    if error is not None:
+                        print(f"Diagramma {os.path.basename(generate_filename(code, output_dir))} in quarantena "
+                              f"(fallito in una build precedente), uso il segnaposto.")
+                        return new_render_result(error=error, quarantined=True)
+                    _, width_px, height_px, _, _ = get_diagram_type_and_dimensions(code)
+                    cache_key = DiagramCache.make_key(
+                        code, config_json, width_px, height_px, renderer_version, diagram_format
+                    )
+                    image_file = cache.get(cache_key, generate_filename(code, output_dir, extension=""))
+                    if image_file is not None:
+                        return new_render_result(image_file)
+                result = await render_mermaid_diagram(
+                    code, output_dir, config_file, renderer, diagram_format, svg_config_file, policy
+                )
+                if cache is not None:
+                    if result["image"] is not None:
+                        cache.put(cache_key, result["image"])
+                        cache.clear_failure(code, renderer_version, backend)
+                    elif result["diagram_error"]:
+                        cache.put_failure(code, renderer_version, backend, result["error"])
+                return result
+            except Exception as e:
+                return new_render_result(exception=e, error=str(e))
+    
+    async def render_all():
+        semaphore = asyncio.Semaphore(max(1, jobs))
+        return await asyncio.gather(*(render(code, semaphore) for code in codes))
+    
+    if jobs > 1 and len(codes) > 1:
+        print(f"Rendering di {len(codes)} diagrammi mermaid con {jobs} processi paralleli...")
+    return dict(zip(codes, asyncio.run(render_all())))
+
+DEFAULT_IMAGE_DPI = 300
+DEFAULT_TEXT_WIDTH_CM = 16.0  # A4 con \\geometry{margin=2.5cm}, come main.tex
+IMAGE_TRIM_PADDING = 8
+WIDTH_TEX_PATTERN = re.compile(r"^\s*([\d.]+)\s*\\(?:textwidth|linewidth|columnwidth)")
+
+def new_image_options(dpi=DEFAULT_IMAGE_DPI, text_width_cm=DEFAULT_TEXT_WIDTH_CM, colors=0):
+    """
+    Parametri dell'ottimizzazione dei PNG: risoluzione di stampa, larghezza
+    del testo sulla pagina e numero di colori della palette (0 = nessuna
+    quantizzazione, solo ricompressione senza perdita).
+    """
+    return {"dpi": dpi, "text_width_cm": text_width_cm, "colors": colors}
+
+def target_width_px(width_tex, options):
+    """
+    Larghezza in pixel oltre la quale un'immagine inclusa con width=width_tex
+    supera la risoluzione di stampa richiesta.
+    """
+    match = WIDTH_TEX_PATTERN.match(width_tex)
+    fraction = float(match.group(1)) if match else 1.0
+    return max(1, round(fraction * options["text_width_cm"] / 2.54 * options["dpi"]))
+
+def optimize_png(image_file, width_tex, options):
+    """
+    Rifila i margini bianchi, riduce l'immagine alla risoluzione effettiva
+    che avrà nel PDF e la ricomprime (eventualmente quantizzando i colori).
+    """
+    with Image.open(image_file) as image:
+        image.load()
+    if image.mode not in ("RGB", "L"):
+        # Appiattisce la trasparenza sullo sfondo bianco usato da mmdc
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+        image = background
+    
+    bbox = ImageChops.difference(image, Image.new(image.mode, image.size, "white")).getbbox()
+    if bbox:
+        left, top, right, bottom = bbox
+        image = image.crop((
+            max(0, left - IMAGE_TRIM_PADDING), max(0, top - IMAGE_TRIM_PADDING),
+            min(image.width, right + IMAGE_TRIM_PADDING), min(image.height, bottom + IMAGE_TRIM_PADDING),
+        ))
+    
+    target = target_width_px(width_tex, options)
+    if image.width > target:
+        image = image.resize((target, max(1, round(image.height * target / image.width))), Image.LANCZOS)
+    if options["colors"]:
+        image = image.quantize(colors=options["colors"])
+    
+    temp_file = image_file + ".tmp"
+    image.save(temp_file, format="PNG", optimize=True)
+    os.replace(temp_file, image_file)
+
+def optimize_rendered_images(rendered, jobs=1, cache=None, options=None):
+    """
+    Fase facoltativa tra il render e la sostituzione nei .tex: ottimizza in
+    parallelo i PNG renderizzati (i PDF vettoriali restano invariati).
+    I risultati finiscono nella DiagramCache, indicizzati per contenuto
+    dell'immagine originale e parametri, così ogni PNG si elabora una volta sola.
+    """
+    if Image is None:
+        print("Pillow non installato: ottimizzazione delle immagini saltata (pip install pillow).")
+        return
+    options = options or new_image_options()
+    options_json = json.dumps(options, sort_keys=True)
+    targets = [
+        (code, result["image"]) for code, result in rendered.items()
+        if result["image"] is not None and result["image"].endswith(".png")
+    ]
+    stats = {"before": 0, "after": 0, "cached": 0, "failed": 0}
+    stats_lock = threading.Lock()
+    
+    def optimize(code, image_file):
+        width_tex = get_diagram_type_and_dimensions(code)[3]
+        before = os.path.getsize(image_file)
+        cached = False
+        try:
+            cache_key = None
+            if cache is not None:
+                cache_key = DiagramCache.make_key(
+                    file_sha256(image_file), options_json, width_tex, "", "optimize", "png"
+                )
+                cached = cache.get(cache_key, os.path.splitext(image_file)[0]) is not None
+            if not cached:
+                with PROFILER.phase("optimize_png", category="render", diagram=os.path.basename(image_file)):
+                    optimize_png(image_file, width_tex, options)
+                if cache_key is not None:
+                    cache.put(cache_key, image_file)
+        except Exception as e:
+            print(f"Ottimizzazione di {os.path.basename(image_file)} non riuscita: {str(e)}")
+            with stats_lock:
+                stats["failed"] += 1
+            return
+        after = os.path.getsize(image_file)
+        with stats_lock:
+            stats["before"] += before
+            stats["after"] += after
+            stats["cached"] += cached
+    
+    async def optimize_all():
+        semaphore = asyncio.Semaphore(max(1, jobs))
+        
+        async def run(code, image_file):
+            async with semaphore:
+                await asyncio.to_thread(optimize, code, image_file)
+        
+        await asyncio.gather(*(run(code, image_file) for code, image_file in targets))
     
+    asyncio.run(optimize_all())
+    PROFILER.count("image_bytes_saved", stats["before"] - stats["after"])
+    if targets:
+        print(f"Immagini ottimizzate: {len(targets) - stats['failed']} ({stats['cached']} dalla cache), "
+              f"{stats['before'] / (1024 * 1024):.1f} MB -> {stats['after'] / (1024 * 1024):.1f} MB")
+
+TEX_TOKEN_PATTERN = re.compile(
+    r"(?P<mermaid>```mermaid\s+(?P<code>.*?)```)"
+    r"|(?P<begin_document>\\begin\{document\})"
+    r"|(?P<heading>\\(?:chapter|(?:sub)*section)\*?\{[^}]*\})",
+    re.DOTALL
+)
+
+# Parametri del planner delle figure (frazioni di \textheight, lunghezze in caratteri di testo)
+DEFAULT_TEXT_HEIGHT_CM = 24.7  # A4 con \geometry{margin=2.5cm}, come main.tex
+FIGURE_MAX_HEIGHT = 0.8  # Lascia spazio alla didascalia entro \topfraction=0.9
+FIGURE_INLINE_HEIGHT = 0.5  # Oltre questa altezza un gruppo di figure diventa flottante
+FIGURE_CLUSTER_GAP = 400  # Figure separate da meno testo formano un unico gruppo
+FIGURE_HEADING_GAP = 300  # Testo massimo tra un titolo e la figura da tenere con esso
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PDF_MEDIABOX_PATTERN = re.compile(rb"/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s*\]")
+
+def build_diagram_index(files, locations=None):
+    """
+    Pre-scansione globale: per ogni file .tex restituisce l'elenco dei codici
+    Mermaid che contiene, nell'ordine in cui compaiono. Da qui derivano sia i
+    diagrammi unici da renderizzare sia il conteggio per file.
+    Se è indicato il dizionario `locations`, vi registra per ogni codice le
+    posizioni (file, riga) in cui compare.
+    """
+    index = {}
+    for file_path in files:
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except Exception as e:
+            print(f"Errore nella lettura del file {os.path.basename(file_path)}: {str(e)}")
+            continue
+        codes = []
+        line, position = 1, 0
+        for match in MERMAID_PATTERN.finditer(content):
+            code = match.group(1).strip()
+            codes.append(code)
+            if locations is not None:
+                line += content.count("\n", position, match.start())
+                position = match.start()
+                locations.setdefault(code, []).append((file_path, line))
+        index[file_path] = codes
+    return index
+
+def unique_diagrams(index):
+    """
+    Restituisce i codici Mermaid unici di un indice, nell'ordine di prima comparsa.
+    """
+    diagrams = {}
+    for codes in index.values():
+        for code in codes:
+            diagrams.setdefault(code, None)
+    return list(diagrams)
+
+def preamble_additions(content):
+    """
+    Restituisce il blocco di configurazione da inserire prima di \\begin{document}
+    per ottimizzare il layout e massimizzare lo spazio disponibile per le figure.
+    """
     # Cerca se alcuni pacchetti sono già inclusi
     float_included = "\\usepackage{float}" in content
     graphicx_included = "\\usepackage{graphicx}" in content
@@ -302,119 +1441,1642 @@ def modify_preamble(main_tex_path):
         "\\setcounter{bottomnumber}{2}  % Aumenta il numero di float nella parte inferiore"
     ])
     
-    # Se ci sono modifiche da fare, inseriscile prima di \begin{document}
-    if additions:
-        modifications = "\n% Configurazioni aggiunte automaticamente per ottimizzare il layout delle figure\n"
-        modifications += "\n".join(additions) + "\n"
-        
-        # Trova la posizione di \begin{document}
-        begin_doc_pos = content.find("\\begin{document}")
-        if begin_doc_pos != -1:
-            # Inserisci le modifiche prima di \begin{document}
-            modified_content = content[:begin_doc_pos] + modifications + content[begin_doc_pos:]
-            
-            # Scrivi il file modificato
-            with open(main_tex_path, 'w', encoding='utf-8') as f:
-                f.write(modified_content)
-            
-            print(f"Preambolo del file {main_tex_path} modificato con successo per ottimizzare il layout.")
-        else:
-            print(f"Avviso: \\begin{{document}} non trovato in {main_tex_path}, preambolo non modificato.")
+    modifications = "\n% Configurazioni aggiunte automaticamente per ottimizzare il layout delle figure\n"
+    modifications += "\n".join(additions) + "\n"
+    return modifications
 
-def process_all_tex_files(root_dir, output_dir, project_copy_dir):
+def image_aspect_ratio(image_file):
     """
-    Elabora ricorsivamente tutti i file .tex in root_dir sostituendo i blocchi Mermaid.
+    Rapporto altezza/larghezza di un'immagine renderizzata, letto
+    dall'intestazione del PNG o dal MediaBox del PDF senza decodificarla.
+    Restituisce None se il formato non è riconosciuto o il file è troncato.
     """
-    for dirpath, _, filenames in os.walk(root_dir):
-        for filename in filenames:
-            if filename.endswith(".tex"):
-                file_path = os.path.join(dirpath, filename)
-                print(f"Elaborazione del file {file_path}...")
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    new_content = process_mermaid_blocks_in_content(content, output_dir, project_copy_dir)
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        f.write(new_content)
-                except Exception as e:
-                    print(f"Errore nell'elaborazione del file {filename}: {str(e)}")
+    try:
+        with open(image_file, 'rb') as f:
+            header = f.read(24)
+            if header.startswith(PNG_SIGNATURE):
+                if len(header) < 24:
+                    return None
+                width, height = struct.unpack(">II", header[16:24])
+            else:
+                match = PDF_MEDIABOX_PATTERN.search(header + f.read())
+                if not match:
+                    return None
+                x0, y0, x1, y1 = (float(value) for value in match.groups())
+                width, height = x1 - x0, y1 - y0
+    except (OSError, struct.error, ValueError):
+        return None
+    return height / width if width > 0 and height > 0 else None
 
-def copy_project(src, dst, exclude_dirs=[]):
+def tokenize_tex(content):
     """
-    Copia il progetto sorgente in dst, escludendo le directory specificate in exclude_dirs.
+    Unica scansione di un file .tex: blocchi Mermaid, \\begin{document} e
+    titoli di (sotto)sezione, nell'ordine del file. La stessa lista serve al
+    planner delle figure e a rewrite_tex_chunks.
     """
-    for item in os.listdir(src):
-        s = os.path.join(src, item)
-        d = os.path.join(dst, item)
-        if os.path.isdir(s) and item in exclude_dirs:
-            continue  # Salta le directory da escludere
-        if os.path.isdir(s):
-            shutil.copytree(s, d, dirs_exist_ok=True)
-        else:
-            shutil.copy2(s, d)
+    return list(TEX_TOKEN_PATTERN.finditer(content))
 
-def check_mermaid_cli():
+def index_chapter_figures(content, tokens, rendered):
     """
-    Verifica che mmdc (Mermaid CLI) sia installato e funzionante.
-    Restituisce True se funziona, False altrimenti.
+    Indice delle figure Mermaid di un capitolo, costruito dai token di
+    tokenize_tex nell'ordine in cui rewrite_tex_chunks le sostituisce. Per
+    ognuna annota la larghezza proposta da get_diagram_type_and_dimensions, il
+    rapporto altezza/larghezza dell'immagine renderizzata, il testo che la
+    separa dalla figura precedente e, se nel frattempo non ci sono altre
+    figure, dal titolo di (sotto)sezione che la precede.
+    """
+    figures = []
+    position = 0
+    text_since_figure = None
+    text_since_heading = None
+    
+    for match in tokens:
+        if match.lastgroup == "begin_document":
+            continue
+        text = len(content[position:match.start()].strip())
+        position = match.end()
+        if text_since_figure is not None:
+            text_since_figure += text
+        if text_since_heading is not None:
+            text_since_heading += text
+        
+        if match.lastgroup == "heading":
+            text_since_heading = 0
+            continue
+        
+        code = match.group("code").strip()
+        result = rendered.get(code)
+        image_file = result["image"] if result else None
+        _, width_px, height_px, width_tex, _ = get_diagram_type_and_dimensions(code)
+        width_match = WIDTH_TEX_PATTERN.match(width_tex)
+        aspect = image_aspect_ratio(image_file) if image_file else None
+        figures.append({
+            "code": code,
+            "image": image_file,
+            "width": float(width_match.group(1)) if width_match else 1.0,
+            "aspect": aspect or height_px / width_px,
+            "gap": text_since_figure,
+            "heading_gap": text_since_heading,
+        })
+        text_since_figure = 0
+        text_since_heading = None
+    return figures
+
+def safe_figure_layout(content, tokens, rendered, **geometry):
+    """
+    Come plan_figure_layout, ma un errore del planner non deve mai impedire
+    la sostituzione dei blocchi Mermaid: in quel caso restituisce un piano
+    vuoto e le figure usano posizionamento e larghezza predefiniti.
     """
     try:
-        result = subprocess.run(["mmdc", "--version"], capture_output=True, text=True, check=False)
-        if result.returncode == 0:
-            print(f"Mermaid CLI (mmdc) trovato: {result.stdout.strip()}")
-            return True
-        else:
-            print("Mermaid CLI (mmdc) non funziona correttamente.")
-            return False
-    except FileNotFoundError:
-        print("ERRORE: mermaid-cli (mmdc) non è installato o non è nel PATH.")
-        print("Installa mermaid-cli con: npm install -g @mermaid-js/mermaid-cli")
-        return False
+        return plan_figure_layout(content, tokens, rendered, **geometry)
+    except Exception as e:
+        print(f"Avviso: pianificazione del layout non riuscita ({str(e)}), uso il layout predefinito.")
+        return []
 
-def optimize_layout_post_process(main_tex_path):
+def plan_figure_layout(content, tokens, rendered, text_width_cm=DEFAULT_TEXT_WIDTH_CM, text_height_cm=DEFAULT_TEXT_HEIGHT_CM):
     """
-    Esegue una post-elaborazione del file .tex principale per ottimizzare ulteriormente
-    il layout, aggiungendo comandi per evitare interruzioni di pagina indesiderate.
+    Sceglie posizionamento e larghezza di tutte le figure di un capitolo in
+    una volta sola, a partire da index_chapter_figures:
+      - riduce la larghezza delle figure che supererebbero FIGURE_MAX_HEIGHT
+        della pagina (la larghezza non cresce mai rispetto a quella proposta,
+        così i PNG ottimizzati da optimize_rendered_images restano a risoluzione
+        sufficiente);
+      - raggruppa le figure della stessa (sotto)sezione separate da poco
+        testo: un gruppo che occupa al più FIGURE_INLINE_HEIGHT della pagina
+        resta nel testo con [H], altrimenti tutte le sue figure diventano
+        flottanti con [!htbp], che ammette le pagine di sole figure ed evita
+        gli accumuli a fine capitolo (le figure dello stesso gruppo condividono
+        il posizionamento per non invertirne l'ordine);
+      - una figura isolata subito dopo un titolo resta con [H] ed è preceduta
+        da \\nopagebreak, così titolo e figura non finiscono su pagine diverse.
+    Restituisce un piano per figura, nello stesso ordine dell'indice.
     """
-    with open(main_tex_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+    figures = index_chapter_figures(content, tokens, rendered)
+    page_ratio = text_width_cm / text_height_cm
     
-    # Evita che sezioni siano seguite immediatamente da un'interruzione di pagina
-    # e che le figure rimangano sole
-    modified = re.sub(
-        r'(\\section{[^}]+})\s*\\begin{figure}',
-        r'\1\n\\nopagebreak\n\\begin{figure}',
-        content
-    )
+    plans = []
+    for figure in figures:
+        width = figure["width"]
+        height = width * figure["aspect"] * page_ratio
+        resized = height > FIGURE_MAX_HEIGHT
+        if resized:
+            width = FIGURE_MAX_HEIGHT / (figure["aspect"] * page_ratio)
+            height = FIGURE_MAX_HEIGHT
+        plans.append({
+            "width_tex": f"{width:.2f}\\textwidth",
+            "height": height if figure["image"] else 0.0,
+            "placement": "H",
+            "nopagebreak": False,
+            "resized": resized,
+        })
     
-    # Evita che le figure siano separate dal loro testo correlato
-    modified = re.sub(
-        r'(\\subsection{[^}]+})\s*\\begin{figure}',
-        r'\1\n\\nopagebreak\n\\begin{figure}',
-        modified
-    )
+    clusters = []
+    for figure, plan in zip(figures, plans):
+        same_section = figure["gap"] is not None and figure["heading_gap"] is None
+        if clusters and same_section and figure["gap"] < FIGURE_CLUSTER_GAP:
+            clusters[-1].append((figure, plan))
+        else:
+            clusters.append([(figure, plan)])
     
-    with open(main_tex_path, 'w', encoding='utf-8') as f:
-        f.write(modified)
+    for cluster in clusters:
+        first_figure = cluster[0][0]
+        after_heading = first_figure["heading_gap"] is not None and first_figure["heading_gap"] <= FIGURE_HEADING_GAP
+        total_height = sum(plan["height"] for _, plan in cluster)
+        inline = total_height <= FIGURE_INLINE_HEIGHT or (len(cluster) == 1 and after_heading)
+        for figure, plan in cluster:
+            plan["placement"] = "H" if inline else "!htbp"
+            plan["nopagebreak"] = inline and figure is first_figure and after_heading
+    return plans
+
+def print_layout_plan(plans):
+    """
+    Riepilogo delle scelte del planner per un capitolo.
+    """
+    if not plans:
+        return
+    floating = sum(plan["placement"] != "H" for plan in plans)
+    resized = sum(plan["resized"] for plan in plans)
+    kept = sum(plan["nopagebreak"] for plan in plans)
+    print(f"Layout delle figure: {len(plans) - floating} nel testo [H], {floating} flottanti, "
+          f"{resized} ridotte in altezza, {kept} legate al titolo")
+
+def mermaid_figure(code, rendered, base_dir, plan=None):
+    """
+    Restituisce l'ambiente figure (o il segnaposto di errore) che sostituisce
+    un blocco Mermaid già renderizzato, con posizionamento e larghezza scelti
+    da plan_figure_layout (in mancanza del piano, [H] e la larghezza proposta
+    da get_diagram_type_and_dimensions).
+    """
+    result = rendered[code]
+    image_file = result["image"]
+    
+    if result["exception"] is not None:
+        print(f"Eccezione nella generazione del diagramma: {str(result['exception'])}")
+        return PLACEHOLDER_ERROR
+    if image_file is None:
+        return PLACEHOLDER_TIMEOUT if result["timed_out"] else PLACEHOLDER_NOT_GENERATED
+    
+    # Analizza il diagramma per determinare la didascalia e la larghezza predefinita
+    _, _, _, width_tex, caption = get_diagram_type_and_dimensions(code)
+    placement_option = "H"
+    if plan is not None:
+        width_tex = plan["width_tex"]
+        placement_option = plan["placement"]
+    
+    # Calcola il percorso relativo dell'immagine
+    relative_path = os.path.relpath(image_file, base_dir)
+    
+    # Costruisci l'ambiente figure ottimizzato per massimizzare lo spazio disponibile
+    # Rimuoviamo l'opzione keepaspectratio per permettere alla figura di espandersi
+    # fino alla dimensione specificata
+    figure_env = f"""
+\\begin{{figure}}[{placement_option}]
+  \\centering
+  \\setlength{{\\fboxsep}}{{1pt}}%
+  \\includegraphics[width={width_tex}]{{{relative_path}}}
+  \\caption{{{caption}}}
+\\end{{figure}}
+"""
+    if plan is not None and plan["nopagebreak"]:
+        return "\\nopagebreak\n" + figure_env.strip()
+    return figure_env.strip()
+
+def rewrite_tex_chunks(content, tokens=None, figure_for=None, preamble=False, stats=None):
+    """
+    Riscrive un file .tex a partire dai token di tokenize_tex (se non indicati
+    li calcola), restituendo il risultato come sequenza di frammenti da
+    scrivere direttamente sul file di destinazione. Nella stessa passata:
+      - sostituisce i blocchi Mermaid con figure_for(codice), se indicato;
+      - inserisce le configurazioni del preambolo prima di \\begin{document}.
+    In `stats` viene annotato l'inserimento del preambolo.
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault("preamble_inserted", False)
+    if tokens is None:
+        tokens = tokenize_tex(content)
+    position = 0
+    
+    for match in tokens:
+        if match.start() > position:
+            yield content[position:match.start()]
+        position = match.end()
+        
+        if match.lastgroup == "mermaid" and figure_for is not None:
+            yield figure_for(match.group("code").strip())
+        elif match.lastgroup == "begin_document" and preamble and not stats["preamble_inserted"]:
+            stats["preamble_inserted"] = True
+            yield preamble_additions(content) + match.group(0)
+        else:
+            yield match.group(0)
+    
+    if position < len(content):
+        yield content[position:]
+
+def write_tex_chunks(file_path, chunks):
+    """
+    Scrive i frammenti prodotti da rewrite_tex_chunks su un file temporaneo e
+    lo sostituisce atomicamente a file_path.
+    """
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(temp_path, file_path)
+
+def process_mermaid_blocks_in_content(tex_content, output_dir, base_dir, rendered=None, diagrams_count=None):
+    """
+    Cerca i blocchi di codice Mermaid e li converte in PNG ad alta qualità,
+    ottimizzati per occupare più spazio nella pagina.
+    Se `rendered` contiene già i risultati di render_diagrams_parallel, esegue
+    solo la pianificazione del layout e la sostituzione senza lanciare mmdc.
+    """
+    # Assicurati che la directory di output esista
+    os.makedirs(output_dir, exist_ok=True)
+    
+    codes = [code.strip() for code in MERMAID_PATTERN.findall(tex_content)]
+    if diagrams_count is None:
+        diagrams_count = len(codes)
+    print(f"Trovati {diagrams_count} diagrammi mermaid da elaborare")
+    
+    rendered = dict(rendered or {})
+    missing = [code for code in dict.fromkeys(codes) if code not in rendered]
+    if missing:
+        # Il planner ha bisogno delle immagini: renderizza prima quelle mancanti
+        config_file = create_mermaid_config()
+        try:
+            rendered.update(render_diagrams_parallel(missing, output_dir, config_file))
+        finally:
+            if os.path.exists(config_file):
+                os.remove(config_file)
+    
+    tokens = tokenize_tex(tex_content)
+    plans = iter(safe_figure_layout(tex_content, tokens, rendered))
+    return "".join(rewrite_tex_chunks(
+        tex_content, tokens,
+        figure_for=lambda code: mermaid_figure(code, rendered, base_dir, next(plans, None))
+    ))
+
+def modify_preamble(main_tex_path):
+    """
+    Modifica il preambolo del file LaTeX per ottimizzare il layout
+    e massimizzare lo spazio disponibile per le figure.
+    """
+    with open(main_tex_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    
+    stats = {}
+    chunks = list(rewrite_tex_chunks(content, preamble=True, stats=stats))
+    if stats["preamble_inserted"]:
+        write_tex_chunks(main_tex_path, chunks)
+        print(f"Preambolo del file {main_tex_path} modificato con successo per ottimizzare il layout.")
+    else:
+        print(f"Avviso: \\begin{{document}} non trovato in {main_tex_path}, preambolo non modificato.")
+
+def process_all_tex_files(root_dir, output_dir, project_copy_dir, jobs=1, cache=None, renderer_version="", files=None, renderer=None, main_tex_path=None,
+                          diagram_format="png", policy=None, retry_failed=False, image_options=None):
+    """
+    Elabora ricorsivamente tutti i file .tex in root_dir sostituendo i blocchi Mermaid.
+    Prima costruisce l'indice globale dei diagrammi e renderizza in parallelo
+    quelli unici, poi riscrive ogni file in un'unica passata.
+    Con `files` si limita l'elaborazione ai soli file indicati; il file
+    main_tex_path riceve nella stessa passata anche le modifiche al preambolo.
+    Posizionamento e larghezza delle figure di ogni file sono scelti da
+    plan_figure_layout prima della sostituzione.
+    Con image_options i PNG renderizzati passano per optimize_rendered_images
+    prima di essere inclusi.
+    Restituisce i risultati dei render (codice -> new_render_result).
+    """
+    if files is None:
+        files = find_tex_files(root_dir)
+    index = build_diagram_index(files)
+    codes = unique_diagrams(index)
+    print(f"Trovati {len(codes)} diagrammi mermaid unici nel progetto")
     
-    print("Post-elaborazione del layout completata con successo.")
+    config_file = create_mermaid_config()
+    svg_config_file = create_mermaid_config(html_labels=False) if diagram_format in ("svg", "auto") else None
+    try:
+        with PROFILER.phase("render_diagrams", diagrams=len(codes)):
+            rendered = render_diagrams_parallel(
+                codes, output_dir, config_file, jobs=jobs,
+                cache=cache, renderer_version=renderer_version, renderer=renderer,
+                diagram_format=diagram_format, svg_config_file=svg_config_file, policy=policy,
+                retry_failed=retry_failed
+            )
+        if image_options is not None:
+            with PROFILER.phase("optimize_images"):
+                optimize_rendered_images(rendered, jobs=jobs, cache=cache, options=image_options)
+    finally:
+        for temp_config in (config_file, svg_config_file):
+            if temp_config and os.path.exists(temp_config):
+                os.remove(temp_config)
+    
+    layout_geometry = {}
+    if image_options is not None:
+        layout_geometry["text_width_cm"] = image_options["text_width_cm"]
+    
+    for file_path in files:
+        filename = os.path.basename(file_path)
+        print(f"Elaborazione del file {file_path}...")
+        try:
+            with PROFILER.phase("process_tex_file", file=os.path.relpath(file_path, root_dir)):
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+                diagrams_count = len(index.get(file_path, []))
+                print(f"Trovati {diagrams_count} diagrammi mermaid da elaborare")
+                is_main = main_tex_path is not None and os.path.abspath(file_path) == os.path.abspath(main_tex_path)
+                tokens = tokenize_tex(content)
+                plans = safe_figure_layout(content, tokens, rendered, **layout_geometry)
+                print_layout_plan(plans)
+                plan_iter = iter(plans)
+                stats = {}
+                chunks = rewrite_tex_chunks(
+                    content, tokens,
+                    figure_for=lambda code: mermaid_figure(code, rendered, project_copy_dir, next(plan_iter, None)),
+                    preamble=is_main, stats=stats
+                )
+                write_tex_chunks(file_path, chunks)
+                if is_main:
+                    if stats["preamble_inserted"]:
+                        print(f"Preambolo del file {file_path} modificato con successo per ottimizzare il layout.")
+                    else:
+                        print(f"Avviso: \\begin{{document}} non trovato in {file_path}, preambolo non modificato.")
+        except Exception as e:
+            print(f"Errore nell'elaborazione del file {filename}: {str(e)}")
+    return rendered
 
-def main():
+def report_render_failures(project_dir, failures, cache=None, renderer_version="", exclude=None,
+                           backend=SubprocessRenderer.name):
+    """
+    Elenca con file, riga ed errore ogni diagramma del progetto che non è
+    stato possibile renderizzare: quelli falliti in questa build (`failures`,
+    codice -> errore) e quelli in quarantena nella cache negativa, anche se
+    appartengono a file che una build incrementale non ha rielaborato.
+    """
+    files = [
+        os.path.join(project_dir, rel_path)
+        for rel_path in iter_stage_files(project_dir, ["*.tex"], exclude or DEFAULT_STAGE_EXCLUDES)
+    ]
+    locations = {}
+    build_diagram_index(files, locations)
+    
+    broken = []
+    for code, places in locations.items():
+        error = failures.get(code)
+        if error is None and cache is not None:
+            error = cache.lookup_failure(code, renderer_version, backend)
+        if error is None:
+            continue
+        for file_path, line in places:
+            broken.append((os.path.relpath(file_path, project_dir), line, classify_diagram(code)["type"], error))
+    
+    if not broken:
+        print("\nNessun diagramma Mermaid con errori di render.")
+        return broken
+    print(f"\nDiagrammi Mermaid non renderizzati ({len(broken)}):")
+    for rel_path, line, diagram_type, error in sorted(broken):
+        error_lines = (error or "errore sconosciuto").strip().splitlines() or ["errore sconosciuto"]
+        print(f"  {rel_path}:{line} [{diagram_type}] {error_lines[0]}")
+        for error_line in error_lines[1:5]:
+            print(f"      {error_line}")
+    return broken
+
+DEFAULT_STAGE_EXCLUDES = [
+    "temp_build", DEFAULT_CACHE_DIRNAME, "benchmark_results", ".DS_Store", "__pycache__",
+    "*.aux", "*.log", "*.toc", "*.out", "*.lof", "*.lot", "*.synctex.gz", "*.fls", "*.fdb_latexmk",
+]
+STAGE_MODES = ("auto", "reflink", "hardlink", "copy")
+# Solo questi input, che pdflatex legge e non riscrive mai, possono essere
+# condivisi con un hard link: un file ausiliario collegato (.lol, .idx, .bcf,
+# .nav, ...) verrebbe troncato e riscritto attraverso il link nel sorgente
+STAGE_LINK_PATTERNS = [
+    "*.tex", "*.sty", "*.cls", "*.bib", "*.bst",
+    "*.png", "*.jpg", "*.jpeg", "*.pdf", "*.eps", "*.svg",
+]
+FICLONE = 0x40049409  # ioctl Linux per il reflink (btrfs, xfs, ...)
+
+def matches_any(rel_path, patterns):
+    """
+    Verifica se il percorso relativo (o il solo nome del file) corrisponde a
+    uno dei glob indicati.
+    """
+    rel_path = rel_path.replace(os.sep, "/")
+    name = rel_path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+def iter_stage_files(src, include=None, exclude=None):
+    """
+    Restituisce i percorsi relativi dei file di src da portare nella copia di
+    build, filtrati con i glob include/exclude. Le directory escluse non
+    vengono nemmeno visitate.
+    """
+    include = include or ["*"]
+    exclude = exclude or []
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel_dir = os.path.relpath(dirpath, src)
+        rel_dir = "" if rel_dir == "." else rel_dir
+        dirnames[:] = sorted(d for d in dirnames if not matches_any(os.path.join(rel_dir, d), exclude))
+        for filename in sorted(filenames):
+            rel_path = os.path.join(rel_dir, filename)
+            if matches_any(rel_path, include) and not matches_any(rel_path, exclude):
+                yield rel_path
+
+def stage_link_allowed(rel_path, main_tex=None):
+    """
+    Indica se un file della copia di build può essere un hard link al
+    sorgente: solo gli input in STAGE_LINK_PATTERNS, esclusi i file del job
+    principale (main.pdf e simili) che pdflatex rigenera.
+    """
+    if main_tex and rel_path != main_tex and os.path.splitext(rel_path)[0] == os.path.splitext(main_tex)[0]:
+        return False
+    return matches_any(rel_path, STAGE_LINK_PATTERNS)
+
+def tex_needs_rewrite(path, is_main=False):
+    """
+    Indica se la pipeline riscriverà il file: il .tex principale (preambolo)
+    e ogni .tex che contiene blocchi Mermaid.
+    """
+    if not path.endswith(".tex"):
+        return False
+    if is_main:
+        return True
+    # Confronto sui byte: un .tex in un'altra codifica (o illeggibile) non
+    # deve far fallire lo staging, viene solo collegato o copiato così com'è
+    try:
+        with open(path, 'rb') as f:
+            return b"```mermaid" in f.read()
+    except OSError:
+        return False
+
+def reflink_file(src, dst):
+    """
+    Clona src in dst con copy-on-write, se il filesystem lo supporta.
+    """
+    if fcntl is None:
+        raise OSError("reflink non supportato su questa piattaforma")
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+    shutil.copystat(src, dst)
+
+def stage_file(src, dst, mode="auto", link=True):
+    """
+    Porta un file nella copia di build senza duplicarne i dati quando possibile:
+    reflink, poi hard link (solo con link=True), infine copia.
+    Restituisce il metodo usato.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode in ("auto", "reflink"):
+        try:
+            reflink_file(src, dst)
+            return "reflink"
+        except OSError:
+            pass
+    if link and mode in ("auto", "hardlink"):
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    copy_file_counted(src, dst)
+    return "copy"
+
+def new_stage_stats():
+    return {"linked": 0, "copied": 0, "removed": 0, "bytes_avoided": 0, "bytes_copied": 0}
+
+def record_staged(stats, method, size):
+    if method == "copy":
+        stats["copied"] += 1
+        stats["bytes_copied"] += size
+    else:
+        stats["linked"] += 1
+        stats["bytes_avoided"] += size
+        PROFILER.count("bytes_avoided", size)
+
+def print_stage_stats(stats):
+    print(f"Staging: {stats['linked']} file collegati ({stats['bytes_avoided'] / (1024 * 1024):.1f} MB di copia evitati), "
+          f"{stats['copied']} file copiati ({stats['bytes_copied'] / (1024 * 1024):.1f} MB)")
+
+def stage_project(src, dst, main_tex=None, include=None, exclude=None, mode="auto"):
+    """
+    Prepara la copia di build in dst. I file che la pipeline non riscrive
+    vengono collegati (reflink o hard link, con copia come ripiego); solo i
+    .tex che verranno modificati sono materializzati come copie reali.
+    Restituisce (file_tex_da_elaborare, statistiche).
+    """
+    stats = new_stage_stats()
+    to_process = []
+    for rel_path in iter_stage_files(src, include, exclude):
+        s = os.path.join(src, rel_path)
+        d = os.path.join(dst, rel_path)
+        os.makedirs(os.path.dirname(d), exist_ok=True)
+        size = os.path.getsize(s)
+        if tex_needs_rewrite(s, is_main=(rel_path == main_tex)):
+            if os.path.lexists(d):
+                os.remove(d)
+            copy_file_counted(s, d)
+            record_staged(stats, "copy", size)
+            to_process.append(d)
+        else:
+            record_staged(stats, stage_file(s, d, mode, stage_link_allowed(rel_path, main_tex)), size)
+    return to_process, stats
+
+def copy_project(src, dst, exclude_dirs=[]):
+    """
+    Copia il progetto sorgente in dst, escludendo le directory specificate in exclude_dirs.
+    """
+    stage_project(src, dst, exclude=list(exclude_dirs), mode="copy")
+
+BUILD_MANIFEST_FILENAME = "build_manifest.json"
+LATEX_AUX_EXTENSIONS = (".aux", ".toc", ".out", ".lof", ".lot")
+
+def file_sha256(path):
+    """
+    Calcola l'hash SHA-256 del contenuto di un file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def preamble_hash(main_tex_path):
+    """
+    Calcola l'hash del solo preambolo (tutto ciò che precede \\begin{document}).
+    """
+    with open(main_tex_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    begin_doc_pos = content.find("\\begin{document}")
+    preamble = content if begin_doc_pos == -1 else content[:begin_doc_pos]
+    return hashlib.sha256(preamble.encode('utf-8')).hexdigest()
+
+def pipeline_fingerprint(renderer_version, options=()):
+    """
+    Identifica la versione della pipeline: se cambia lo script (e quindi la
+    configurazione Mermaid o l'ambiente figure generato), la versione di mmdc
+    o una delle opzioni che influiscono sull'output (ad esempio il formato dei
+    diagrammi), tutti i capitoli vanno rielaborati.
+    """
+    digest = hashlib.sha256()
+    digest.update(file_sha256(os.path.abspath(__file__)).encode('utf-8'))
+    for part in (renderer_version or "",) + tuple(options):
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def load_build_manifest(manifest_path):
+    """
+    Carica il manifest della build precedente, o un manifest vuoto se assente.
+    """
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_build_manifest(manifest_path, manifest):
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+def sync_project_incremental(src, dst, png_dir, main_tex, previous, fingerprint, include=None, exclude=None, mode="auto",
+                             quarantined=frozenset()):
+    """
+    Aggiorna sul posto la copia del progetto in dst invece di ricrearla.
+    I file non .tex vengono ricollegati solo se dimensione o data di modifica
+    del sorgente differiscono da quelle registrate nel manifest (il confronto
+    con la copia non basta: dopo un hard link è lo stesso inode e una modifica
+    sul posto non si vedrebbe); i file .tex vengono rimaterializzati (e quindi rielaborati)
+    solo se il loro hash, i diagrammi che contengono o la pipeline sono cambiati,
+    oppure se manca l'immagine di un diagramma. I diagrammi in `quarantined`
+    (hash MD5 del sorgente) non avranno mai un'immagine e contano come presenti:
+    altrimenti il loro capitolo verrebbe rielaborato e ricompilato a ogni build.
+    Restituisce (manifest, file_tex_da_elaborare, preambolo_cambiato, statistiche).
+    """
+    same_pipeline = previous.get("pipeline") == fingerprint
+    previous_tex = previous.get("tex", {}) if same_pipeline else {}
+    previous_staged = set(previous.get("staged", []))
+    previous_files = previous.get("files", {})
+    manifest = {"pipeline": fingerprint, "tex": {}, "staged": [], "files": {}}
+    to_process = []
+    stats = new_stage_stats()
+    
+    for rel_path in iter_stage_files(src, include, exclude):
+        s = os.path.join(src, rel_path)
+        d = os.path.join(dst, rel_path)
+        manifest["staged"].append(rel_path)
+        os.makedirs(os.path.dirname(d), exist_ok=True)
+        src_stat = os.stat(s)
+        
+        if not rel_path.endswith(".tex"):
+            signature = [src_stat.st_size, src_stat.st_mtime_ns]
+            manifest["files"][rel_path] = signature
+            if os.path.exists(d) and previous_files.get(rel_path) == signature:
+                continue
+            record_staged(stats, stage_file(s, d, mode, stage_link_allowed(rel_path, main_tex)), src_stat.st_size)
+            continue
+        
+        with open(s, 'rb') as f:
+            data = f.read()
+        source_hash = hashlib.sha256(data).hexdigest()
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            text = ""  # Non in UTF-8: la pipeline non lo elabora, si tratta come file senza diagrammi
+        diagrams = [
+            hashlib.md5(code.strip().encode('utf-8')).hexdigest()
+            for code in MERMAID_PATTERN.findall(text)
+        ]
+        entry = {"hash": source_hash, "diagrams": diagrams}
+        manifest["tex"][rel_path] = entry
+        
+        old_entry = previous_tex.get(rel_path)
+        images_present = all(
+            diagram in quarantined
+            or any(os.path.exists(os.path.join(png_dir, f"mermaid_{diagram}.{extension}")) for extension in ("png", "pdf"))
+            for diagram in diagrams
+        )
+        if old_entry == entry and os.path.exists(d) and images_present:
+            continue
+        if diagrams or rel_path == main_tex:
+            if os.path.lexists(d):
+                os.remove(d)
+            copy_file_counted(s, d)
+            record_staged(stats, "copy", src_stat.st_size)
+            to_process.append(d)
+        else:
+            record_staged(stats, stage_file(s, d, mode, stage_link_allowed(rel_path, main_tex)), src_stat.st_size)
+    
+    # Rimuove dalla copia i file cancellati dal sorgente dopo la build precedente
+    for rel_path in previous_staged - set(manifest["staged"]):
+        stale = os.path.join(dst, rel_path)
+        if os.path.isfile(stale):
+            os.remove(stale)
+            stats["removed"] += 1
+            print(f"Rimosso dalla copia temporanea: {rel_path}")
+    
+    manifest["preamble"] = preamble_hash(os.path.join(src, main_tex))
+    preamble_changed = manifest["preamble"] != previous.get("preamble")
+    return manifest, to_process, preamble_changed, stats
+
+DEFAULT_MAX_LATEX_PASSES = 4
+RERUN_PATTERN = re.compile(r"Rerun to get|Please rerun LaTeX|rerun LaTeX", re.IGNORECASE)
+LATEX_DIAGNOSTICS_FILENAME = "latex_diagnostics.json"
+# Con -file-line-error gli errori hanno la forma "./file.tex:42: messaggio"
+LATEX_FILE_LINE_ERROR = re.compile(r"^(?P<file>[^\s:()][^:()]*\.\w+):(?P<line>\d+): (?P<message>.+)$")
+LATEX_BANG_ERROR = re.compile(r"^! (?P<message>.+)$")
+LATEX_ERROR_LINE = re.compile(r"^l\.(?P<line>\d+)")
+LATEX_UNDEFINED_REFERENCE = re.compile(
+    r"(?:LaTeX|Package natbib) Warning: (?P<kind>Reference|Citation) [`'](?P<key>[^']+)' "
+    r"(?:on page (?P<page>\d+) )?undefined(?: on input line (?P<line>\d+))?"
+)
+LATEX_FLOAT_WARNING = re.compile(
+    r"LaTeX Warning: (?P<message>Float too large for page.*?|`!?h' float specifier changed to .*?)"
+    r"(?: on input line (?P<line>\d+))?\.?$"
+)
+LATEX_BOX_WARNING = re.compile(
+    r"^(?P<kind>Overfull|Underfull) \\(?P<box>[hv]box) \((?P<amount>[^)]*)\)(?:.*?\blines? (?P<line>\d+))?"
+)
+# "LaTeX Error: File ... not found" non è fatale: in nonstopmode un \includegraphics
+# mancante prosegue, mentre un \input mancante termina comunque con "Emergency stop"
+LATEX_FATAL = re.compile(r"Emergency stop|Fatal error occurred|^! I can't find file")
+
+def latex_environment():
+    """
+    Ambiente per pdflatex: max_print_line alto evita che kpathsea spezzi i
+    messaggi a 79 caratteri, così ogni avviso arriva al parser su una riga.
+    """
+    env = dict(os.environ)
+    env.setdefault("max_print_line", "10000")
+    return env
+
+class LatexLogParser:
+    """
+    Analizza l'output di pdflatex riga per riga mentre il processo gira e ne
+    estrae errori (con file e riga), riferimenti non definiti, richieste di
+    rieseguire LaTeX, avvisi sul posizionamento dei float e box over/underfull.
+    feed() restituisce True quando conviene interrompere il passaggio: sempre
+    sugli errori fatali, al primo errore se abort_on_error è attivo.
+    """
+    
+    def __init__(self, abort_on_error=False):
+        self.abort_on_error = abort_on_error
+        self.errors = []
+        self.undefined_references = []
+        self.floats = []
+        self.boxes = []
+        self.rerun_requested = False
+        self.fatal = False
+        self.lines = 0
+        self._pending_error = None
+    
+    def feed(self, line):
+        self.lines += 1
+        if self._pending_error is not None:
+            match = LATEX_ERROR_LINE.match(line)
+            if match:
+                self._pending_error["line"] = int(match.group("line"))
+                self._pending_error = None
+        
+        if LATEX_FATAL.search(line):
+            self.fatal = True
+        match = LATEX_FILE_LINE_ERROR.match(line)
+        if match:
+            self.errors.append({
+                "file": match.group("file"), "line": int(match.group("line")), "message": match.group("message"),
+            })
+            return self.fatal or self.abort_on_error
+        match = LATEX_BANG_ERROR.match(line)
+        if match:
+            error = {"file": None, "line": None, "message": match.group("message")}
+            self.errors.append(error)
+            self._pending_error = error
+            return self.fatal or self.abort_on_error
+        
+        if RERUN_PATTERN.search(line):
+            self.rerun_requested = True
+        match = LATEX_UNDEFINED_REFERENCE.search(line)
+        if match:
+            self.undefined_references.append({
+                "kind": match.group("kind").lower(),
+                "key": match.group("key"),
+                "page": int(match.group("page")) if match.group("page") else None,
+                "line": int(match.group("line")) if match.group("line") else None,
+            })
+            return False
+        match = LATEX_FLOAT_WARNING.search(line)
+        if match:
+            self.floats.append({
+                "message": match.group("message"),
+                "line": int(match.group("line")) if match.group("line") else None,
+            })
+            return False
+        match = LATEX_BOX_WARNING.match(line)
+        if match:
+            self.boxes.append({
+                "kind": match.group("kind").lower(),
+                "box": match.group("box"),
+                "amount": match.group("amount"),
+                "line": int(match.group("line")) if match.group("line") else None,
+            })
+        return self.fatal
+    
+    def to_dict(self):
+        return {
+            "errors": self.errors,
+            "undefined_references": self.undefined_references,
+            "floats": self.floats,
+            "boxes": self.boxes,
+            "rerun_requested": self.rerun_requested,
+            "fatal": self.fatal,
+            "log_lines": self.lines,
+        }
+    
+    def print_errors(self, limit=10):
+        for error in self.errors[:limit]:
+            location = f"{error['file']}:{error['line']}: " if error["file"] else (
+                f"riga {error['line']}: " if error["line"] else "")
+            print(f" - {location}{error['message']}")
+        if len(self.errors) > limit:
+            print(f" ... e altri {len(self.errors) - limit} errori")
+    
+    def print_summary(self):
+        boxes = {kind: sum(1 for box in self.boxes if box["kind"] == kind) for kind in ("overfull", "underfull")}
+        print(f"Diagnostica LaTeX: {len(self.errors)} errori, {len(self.undefined_references)} riferimenti non definiti, "
+              f"{len(self.floats)} avvisi sui float, {boxes['overfull']} overfull e {boxes['underfull']} underfull box.")
+
+def snapshot_latex_state(project_dir, main_tex):
+    """
+    Calcola gli hash dei file ausiliari che pdflatex rilegge al passaggio
+    successivo: i .aux (anche quelli dei capitoli inclusi con \\include) e
+    .toc/.out/.lof/.lot del documento principale.
+    """
+    jobname = os.path.splitext(main_tex)[0]
+    paths = [os.path.join(project_dir, jobname + extension) for extension in LATEX_AUX_EXTENSIONS]
+    for dirpath, _, filenames in os.walk(project_dir):
+        paths.extend(os.path.join(dirpath, filename) for filename in filenames if filename.endswith(".aux"))
+    return {path: file_sha256(path) for path in sorted(set(paths)) if os.path.exists(path)}
+
+def run_latex_pass(project_dir, main_tex, pass_number, draft=False, timeout=DEFAULT_LATEX_TIMEOUT, abort_on_error=False):
+    """
+    Esegue un singolo passaggio di pdflatex analizzandone l'output mentre
+    gira, e ne mostra gli eventuali errori con file e riga.
+    Con draft=True usa -draftmode: aggiorna i file ausiliari senza produrre il PDF.
+    Restituisce il risultato di run_command e il LatexLogParser del passaggio.
+    """
+    cmd = ["pdflatex", "-interaction=nonstopmode", "-file-line-error", "-shell-escape"]
+    if draft:
+        cmd.append("-draftmode")
+    log = LatexLogParser(abort_on_error)
+    result = run_command(cmd + [main_tex], timeout=timeout, cwd=project_dir, on_line=log.feed, env=latex_environment())
+    
+    # Mostra l'output di pdflatex indipendentemente dal successo
+    if result["timed_out"]:
+        print(f"\nERRORE: compilazione {pass_number} interrotta dopo {timeout}s.")
+    elif result["aborted"]:
+        reason = "all'errore fatale" if log.fatal else "al primo errore (--abort-on-error)"
+        print(f"\nERRORE: compilazione {pass_number} interrotta {reason}:")
+        log.print_errors()
+    elif result["returncode"] != 0 or log.errors:
+        print(f"\nERRORE nella compilazione {pass_number}.")
+        if result["stderr"]:
+            print("Errori specifici:")
+            print(result["stderr"])
+        if log.errors:
+            print("\nErrori rilevati:")
+            log.print_errors()
+    else:
+        print(f"\nCompilazione {pass_number} completata con successo.")
+    return result, log
+
+def compile_latex(project_dir, main_tex, max_passes=DEFAULT_MAX_LATEX_PASSES, draft=False, timeout=DEFAULT_LATEX_TIMEOUT,
+                  abort_on_error=False, diagnostics_path=None):
+    """
+    Compila main_tex ripetendo pdflatex solo finché serve: si ferma quando i
+    file ausiliari non cambiano più tra due passaggi e il log non chiede di
+    rieseguire LaTeX, oppure al raggiungimento di max_passes.
+    Il solo messaggio "Rerun" non basta: le modifiche all'indice (.toc) non lo
+    producono, per questo si confrontano anche gli hash dei file ausiliari.
+    Con draft=True tutti i passaggi usano -draftmode (solo file ausiliari).
+    Un passaggio scaduto o con un errore fatale interrompe la compilazione:
+    i successivi fallirebbero allo stesso modo.
+    Con diagnostics_path scrive in JSON la diagnostica di ogni passaggio.
+    Restituisce l'elenco dei passaggi eseguiti con durata ed esito.
+    """
+    passes = []
+    log = None
+    state = snapshot_latex_state(project_dir, main_tex)
+    for pass_number in range(1, max_passes + 1):
+        print(f"\nAvvio compilazione LaTeX {pass_number} (massimo {max_passes})...")
+        started = time.perf_counter()
+        with PROFILER.phase("pdflatex", category="latex", attempt=pass_number, draft=draft):
+            result, log = run_latex_pass(
+                project_dir, main_tex, pass_number, draft=draft, timeout=timeout, abort_on_error=abort_on_error
+            )
+        duration = time.perf_counter() - started
+        
+        new_state = snapshot_latex_state(project_dir, main_tex)
+        aux_changed = new_state != state
+        state = new_state
+        passes.append({
+            "pass": pass_number,
+            "duration": duration,
+            "returncode": result["returncode"],
+            "timed_out": result["timed_out"],
+            "aborted": result["aborted"],
+            "rerun_requested": log.rerun_requested,
+            "aux_changed": aux_changed,
+            "diagnostics": log.to_dict(),
+        })
+        
+        if result["timed_out"] or result["aborted"] or log.fatal:
+            # Un passaggio bloccato o fallito si ripeterebbe identico ai successivi
+            break
+        if not log.rerun_requested and not aux_changed:
+            break
+    else:
+        print(f"Avviso: riferimenti non stabilizzati dopo {max_passes} passaggi.")
+    
+    timings = ", ".join(f"{p['duration']:.1f}s" for p in passes)
+    print(f"Compilazione LaTeX eseguita in {len(passes)} passaggi ({timings}).")
+    if log is not None:
+        # Conta l'ultimo passaggio: gli avvisi dei precedenti possono essere già risolti
+        log.print_summary()
+        for reference in log.undefined_references[:10]:
+            label = "Citazione non definita" if reference["kind"] == "citation" else "Riferimento non definito"
+            print(f" - {label}: {reference['key']}" + (f" (riga {reference['line']})" if reference["line"] else ""))
+    if diagnostics_path:
+        with open(diagnostics_path, 'w', encoding='utf-8') as f:
+            json.dump({"main_tex": main_tex, "draft": draft, "passes": passes}, f, indent=2, ensure_ascii=False)
+        print(f"Diagnostica LaTeX salvata in {diagnostics_path}")
+    return passes
+
+INCLUDE_PATTERN = re.compile(r"^[^%\n]*?\\include\{([^}]+)\}", re.MULTILINE)
+CHAPTER_BUILDS_DIRNAME = "chapter_builds"
+
+def find_included_chapters(main_tex_path):
+    """
+    Restituisce i capitoli inclusi con \\include nel file principale e se dopo
+    l'ultimo \\include c'è altro contenuto prima di \\end{document}.
+    """
+    with open(main_tex_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    matches = list(INCLUDE_PATTERN.finditer(content))
+    if not matches:
+        return [], False
+    end_doc_pos = content.find("\\end{document}", matches[-1].end())
+    tail = content[matches[-1].end():end_doc_pos if end_doc_pos != -1 else len(content)]
+    tail = "\n".join(line.split("%", 1)[0] for line in tail.splitlines()).strip()
+    return [match.group(1).strip() for match in matches], bool(tail)
+
+def pdf_page_count(pdf_path):
+    """
+    Conta le pagine di un PDF con pypdf, se installato, oppure con qpdf.
+    """
+    if pypdf is not None:
+        return len(pypdf.PdfReader(pdf_path).pages)
+    result = run_checked(["qpdf", "--show-npages", pdf_path])
+    return int(result["stdout"].strip())
+
+def merge_pdf_pages(parts, output_path):
+    """
+    Unisce intervalli di pagine di più PDF. `parts` è una lista di
+    (percorso, prima_pagina, ultima_pagina_esclusa), con pagine numerate da 0.
+    """
+    if pypdf is not None:
+        writer = pypdf.PdfWriter()
+        for path, start, end in parts:
+            reader = pypdf.PdfReader(path)
+            for page in reader.pages[start:end]:
+                writer.add_page(page)
+        with open(output_path, 'wb') as f:
+            writer.write(f)
+        return
+    cmd = ["qpdf", "--empty", "--pages"]
+    for path, start, end in parts:
+        if end > start:
+            cmd += [path, f"{start + 1}-{end}"]
+    cmd += ["--", output_path]
+    run_checked(cmd)
+
+def pdf_tools_available():
+    return pypdf is not None or shutil.which("qpdf") is not None
+
+def prepare_chapter_scratch(project_dir, scratch_dir, jobname):
+    """
+    Crea la directory di lavoro di un worker: i sorgenti e le immagini sono
+    collegati, mentre i file ausiliari e quelli del job (che pdflatex
+    riscrive) sono copiati o clonati, così lo stato condiviso in project_dir
+    resta intatto.
+    """
+    if os.path.exists(scratch_dir):
+        shutil.rmtree(scratch_dir)
+    for dirpath, _, filenames in os.walk(project_dir):
+        rel_dir = os.path.relpath(dirpath, project_dir)
+        os.makedirs(os.path.join(scratch_dir, rel_dir), exist_ok=True)
+        for filename in filenames:
+            src = os.path.join(dirpath, filename)
+            dst = os.path.join(scratch_dir, rel_dir, filename)
+            name, extension = os.path.splitext(filename)
+            job_file = rel_dir == "." and name == jobname and filename != jobname + ".tex"
+            if job_file and extension in (".pdf", ".log"):
+                continue
+            if job_file or extension in LATEX_AUX_EXTENSIONS:
+                shutil.copy2(src, dst)
+            else:
+                stage_file(src, dst, link=stage_link_allowed(os.path.relpath(src, project_dir)))
+
+async def run_partial_latex(scratch_dir, main_tex, included, timeout=DEFAULT_LATEX_TIMEOUT, abort_on_error=False):
+    """
+    Compila in scratch_dir il solo sottoinsieme di capitoli indicato, usando
+    \\includeonly e i file .aux condivisi per numeri di pagina e riferimenti.
+    Come per la compilazione completa, un PDF prodotto nonostante errori non
+    fatali è accettato; si scarta solo un passaggio scaduto, interrotto o
+    senza PDF.
+    Restituisce il percorso del PDF prodotto, o None in caso di errore.
+    """
+    jobname = os.path.splitext(main_tex)[0]
+    command = f"\\includeonly{{{','.join(included)}}}\\input{{{main_tex}}}"
+    log = LatexLogParser(abort_on_error)
+    with PROFILER.phase("pdflatex_chapter", category="latex", chapters=",".join(included) or "(frontespizio)"):
+        result = await run_command_async(
+            ["pdflatex", "-interaction=nonstopmode", "-file-line-error", "-shell-escape", f"-jobname={jobname}", command],
+            timeout=timeout, cwd=scratch_dir, on_line=log.feed, env=latex_environment()
+        )
+    pdf_path = os.path.join(scratch_dir, jobname + ".pdf")
+    label = ", ".join(included) or "frontespizio"
+    if result["timed_out"]:
+        print(f"ERRORE: compilazione parziale ({label}) interrotta dopo {timeout}s.")
+        return None
+    if result["aborted"] or not os.path.exists(pdf_path):
+        print(f"ERRORE nella compilazione parziale ({label}).")
+        log.print_errors()
+        return None
+    if result["returncode"] != 0:
+        print(f"Avviso: compilazione parziale ({label}) completata con errori.")
+        log.print_errors()
+    return pdf_path
+
+def compile_chapters_parallel(project_dir, main_tex, build_dir, jobs, max_passes=DEFAULT_MAX_LATEX_PASSES,
+                              timeout=DEFAULT_LATEX_TIMEOUT, abort_on_error=False):
+    """
+    Compila i capitoli in processi pdflatex paralleli e unisce il risultato.
+    1. Passaggi -draftmode sul documento completo finché i .aux convergono:
+       è lo stato condiviso con numeri di pagina e riferimenti di tutti i capitoli.
+    2. Un worker per capitolo, ognuno nella propria directory con
+       \\includeonly{capitolo}, più un worker con \\includeonly{} per il frontespizio.
+    3. Il PDF finale è il frontespizio seguito dalle pagine di ciascun capitolo.
+    Restituisce False se la modalità non è applicabile (nessun \\include,
+    contenuto dopo l'ultimo capitolo, nessuno strumento PDF o un worker
+    fallito): in quel caso il chiamante ripiega sulla compilazione completa.
+    I collegamenti ipertestuali tra capitoli e i segnalibri non sopravvivono
+    all'unione: per la versione definitiva conviene la compilazione completa.
+    """
+    main_tex_path = os.path.join(project_dir, main_tex)
+    jobname = os.path.splitext(main_tex)[0]
+    chapters, has_tail = find_included_chapters(main_tex_path)
+    if not chapters:
+        print("Nessun \\include nel file principale: compilazione completa.")
+        return False
+    if has_tail:
+        print("Contenuto dopo l'ultimo \\include: compilazione completa.")
+        return False
+    if not pdf_tools_available():
+        print("Per unire i capitoli serve pypdf o qpdf: compilazione completa.")
+        return False
+    
+    print(f"\nAggiornamento dello stato condiviso (.aux) per {len(chapters)} capitoli...")
+    passes = compile_latex(
+        project_dir, main_tex, max_passes=max_passes, draft=True, timeout=timeout, abort_on_error=abort_on_error
+    )
+    if passes[-1]["timed_out"] or passes[-1]["aborted"] or passes[-1]["diagnostics"]["fatal"]:
+        return False
+    
+    chapter_builds = os.path.join(build_dir, CHAPTER_BUILDS_DIRNAME)
+    targets = [("frontespizio", [])] + [(chapter, [chapter]) for chapter in chapters]
+    
+    async def build(target, semaphore):
+        name, included = target
+        scratch_dir = os.path.join(chapter_builds, name.replace("/", "_"))
+        async with semaphore:
+            await asyncio.to_thread(prepare_chapter_scratch, project_dir, scratch_dir, jobname)
+            return await run_partial_latex(scratch_dir, main_tex, included, timeout=timeout, abort_on_error=abort_on_error)
+    
+    async def build_all():
+        semaphore = asyncio.Semaphore(max(1, jobs))
+        return await asyncio.gather(*(build(target, semaphore) for target in targets))
+    
+    print(f"Compilazione parallela di {len(chapters)} capitoli con {jobs} processi...")
+    pdfs = asyncio.run(build_all())
+    if any(pdf is None for pdf in pdfs):
+        return False
+    
+    output_pdf = os.path.join(project_dir, jobname + ".pdf")
+    try:
+        frontmatter_pages = pdf_page_count(pdfs[0])
+        parts = [(pdfs[0], 0, frontmatter_pages)]
+        for pdf in pdfs[1:]:
+            parts.append((pdf, frontmatter_pages, pdf_page_count(pdf)))
+        with PROFILER.phase("merge_pdf", parts=len(parts)):
+            merge_pdf_pages(parts, output_pdf)
+    except Exception as e:
+        # PDF parziali illeggibili o unione fallita: non lasciare un main.pdf
+        # a metà e ripiega sulla compilazione completa
+        print(f"Unione dei PDF dei capitoli fallita ({e}): compilazione completa.")
+        if os.path.exists(output_pdf):
+            os.remove(output_pdf)
+        return False
+    print(f"PDF unito da {len(chapters)} capitoli ({frontmatter_pages} pagine di frontespizio).")
+    return True
+
+def check_mermaid_cli():
+    """
+    Verifica che mmdc (Mermaid CLI) sia installato e funzionante.
+    Restituisce la versione riportata da mmdc se funziona, None altrimenti.
+    """
+    try:
+        result = run_command(["mmdc", "--version"], timeout=DEFAULT_TOOL_TIMEOUT)
+        if result["returncode"] == 0 and not result["timed_out"]:
+            version = result["stdout"].strip()
+            print(f"Mermaid CLI (mmdc) trovato: {version}")
+            return version or "unknown"
+        else:
+            print("Mermaid CLI (mmdc) non funziona correttamente.")
+            return None
+    except FileNotFoundError:
+        print("ERRORE: mermaid-cli (mmdc) non è installato o non è nel PATH.")
+        print("Installa mermaid-cli con: npm install -g @mermaid-js/mermaid-cli")
+        return None
+
+DEFAULT_MAIN_TEX = "main.tex"
+DEFAULT_OUTPUT_PDF = "documentazione_finale.pdf"
+WATCH_PATTERNS = ["chapters/*.tex"]
+DEFAULT_WATCH_DEBOUNCE = 0.5
+
+class PollingWatcher:
+    """
+    Osservatore portabile: confronta periodicamente data di modifica e
+    dimensione dei file che corrispondono ai glob indicati.
+    """
+    
+    def __init__(self, root_dir, patterns, interval=0.5):
+        self.root_dir = root_dir
+        self.patterns = patterns
+        self.interval = interval
+        self.state = self._snapshot()
+    
+    def _snapshot(self):
+        state = {}
+        for pattern in self.patterns:
+            for path in glob.glob(os.path.join(self.root_dir, pattern)):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                state[os.path.relpath(path, self.root_dir)] = (stat.st_mtime_ns, stat.st_size)
+        return state
+    
+    def wait(self, timeout=None):
+        """
+        Attende una modifica per al massimo timeout secondi (None: senza limite).
+        Restituisce l'insieme dei file modificati, creati o rimossi.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            current = self._snapshot()
+            changed = {
+                path for path in set(current) | set(self.state)
+                if current.get(path) != self.state.get(path)
+            }
+            self.state = current
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            remaining = self.interval if deadline is None else min(self.interval, max(0, deadline - time.monotonic()))
+            time.sleep(remaining)
+    
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """
+    Osservatore basato su inotify (Linux), senza polling. Osserva le
+    directory che contengono i file, così da cogliere anche gli editor che
+    salvano scrivendo un file nuovo e rinominandolo.
+    """
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    EVENT_HEADER = struct.Struct("iIII")
+    
+    def __init__(self, root_dir, patterns):
+        self.root_dir = root_dir
+        self.patterns = patterns
+        libc_name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 non riuscita")
+        self.watches = {}
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        directories = {os.path.dirname(os.path.join(root_dir, pattern)) for pattern in patterns}
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+            if wd < 0:
+                self.close()
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch non riuscita su {directory}")
+            self.watches[wd] = directory
+    
+    def _read_events(self):
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, _, _, name_length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + name_length].rstrip(b"\0").decode('utf-8', 'replace')
+            offset += name_length
+            if wd not in self.watches or not name:
+                continue
+            rel_path = os.path.relpath(os.path.join(self.watches[wd], name), self.root_dir)
+            if matches_any(rel_path, self.patterns):
+                changed.add(rel_path)
+        return changed
+    
+    def wait(self, timeout=None):
+        """
+        Attende una modifica per al massimo timeout secondi (None: senza limite).
+        Restituisce l'insieme dei file modificati, creati o rimossi.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if ready:
+                changed = self._read_events()
+                if changed:
+                    return changed
+            elif deadline is not None:
+                return set()
+    
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def create_watcher(root_dir, patterns):
+    """
+    Usa inotify dove disponibile, altrimenti il polling.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root_dir, patterns)
+        except (OSError, AttributeError) as e:
+            print(f"inotify non disponibile ({str(e)}), uso il polling.")
+    return PollingWatcher(root_dir, patterns)
+
+def wait_for_changes(watcher, debounce=DEFAULT_WATCH_DEBOUNCE):
+    """
+    Attende la prima modifica e raccoglie le successive finché non trascorrono
+    `debounce` secondi senza nuovi salvataggi.
+    """
+    changed = watcher.wait()
+    while True:
+        more = watcher.wait(debounce)
+        if not more:
+            return changed
+        changed |= more
+
+def watch_and_rebuild(args, project_dir):
+    """
+    Modalità --watch: esegue una build incrementale, poi resta in ascolto di
+    main.tex e dei capitoli e ricompila a ogni gruppo di salvataggi.
+    mmdc viene verificato una sola volta per tutta la sessione, e cache e
+    renderer (con il browser del backend batch) restano aperti tra una
+    ricompilazione e l'altra.
+    """
+    with PROFILER.phase("check_mermaid_cli"):
+        mmdc_version = check_mermaid_cli()
+    if not mmdc_version:
+        print("Non è possibile procedere senza Mermaid CLI.")
+        return
+    
+    cache = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir or os.path.join(project_dir, DEFAULT_CACHE_DIRNAME)
+        cache = DiagramCache(cache_dir, max_bytes=args.cache_size_mb * 1024 * 1024)
+    renderer_cmd = shlex.split(args.renderer_cmd) if args.renderer_cmd else None
+    renderer = create_renderer(args.renderer, renderer_cmd)
+    try:
+        with PROFILER.phase("build"):
+            build_documentation(args, project_dir, mmdc_version, cache=cache, renderer=renderer)
+        
+        watcher = create_watcher(project_dir, ["main.tex"] + WATCH_PATTERNS)
+        print(f"\nIn ascolto delle modifiche con {type(watcher).__name__} (Ctrl-C per uscire)...")
+        try:
+            while True:
+                changed = wait_for_changes(watcher, args.debounce)
+                print(f"\nModifiche rilevate: {', '.join(sorted(changed))}")
+                started = time.perf_counter()
+                with PROFILER.phase("build", trigger=sorted(changed)):
+                    build_documentation(args, project_dir, mmdc_version, cache=cache, renderer=renderer)
+                print(f"Ricompilazione completata in {time.perf_counter() - started:.1f}s. In ascolto...")
+        except KeyboardInterrupt:
+            print("\nModalità watch terminata.")
+        finally:
+            watcher.close()
+    finally:
+        renderer.close()
+
+def load_documents_manifest(manifest_path):
+    """
+    Legge il manifest di una build multi-documento: un file JSON con una lista
+    "documents" (oppure direttamente una lista) di oggetti
+    {"root", "main_tex", "output", "name"}, dove solo "root" è obbligatorio.
+    I percorsi relativi sono risolti rispetto alla directory del manifest.
+    Ogni documento usa come directory di build temp_build/<name> nella sua
+    root, quindi due documenti con la stessa root devono avere nomi diversi.
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    entries = data.get("documents", []) if isinstance(data, dict) else data
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    documents = []
+    build_dirs = {}
+    for entry in entries:
+        root = os.path.normpath(os.path.join(base_dir, entry["root"]))
+        main_tex = entry.get("main_tex", DEFAULT_MAIN_TEX)
+        name = entry.get("name") or (
+            os.path.basename(root) if main_tex == DEFAULT_MAIN_TEX else f"{os.path.basename(root)}_{os.path.splitext(main_tex)[0]}"
+        )
+        build_name = name.replace("/", "_").replace(os.sep, "_")
+        if (root, build_name) in build_dirs:
+            raise ValueError(f"i documenti \"{build_dirs[(root, build_name)]}\" e \"{name}\" userebbero la stessa "
+                             f"directory di build temp_build/{build_name} in {root}: indica un \"name\" diverso")
+        build_dirs[(root, build_name)] = name
+        documents.append({
+            "name": name,
+            "root": root,
+            "main_tex": main_tex,
+            "output": entry.get("output", DEFAULT_OUTPUT_PDF),
+            "build_name": build_name,
+        })
+    return documents
+
+def build_documents(args, manifest_path):
+    """
+    Costruisce tutti i documenti del manifest in un solo processo.
+    mmdc viene verificato una volta, cache e renderer sono condivisi: la
+    conversione dei diagrammi avviene un documento alla volta, così un
+    diagramma presente in più documenti si renderizza una sola volta e i
+    successivi lo copiano dalla cache. Le compilazioni LaTeX, indipendenti,
+    girano poi in parallelo (al massimo --document-jobs alla volta).
+    Restituisce True se tutti i PDF sono stati generati.
+    """
+    try:
+        documents = load_documents_manifest(manifest_path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Manifest {manifest_path} non valido: {str(e)}")
+        return False
+    if not documents:
+        print(f"Nessun documento nel manifest {manifest_path}.")
+        return False
+    
+    with PROFILER.phase("check_mermaid_cli"):
+        mmdc_version = check_mermaid_cli()
+    if not mmdc_version:
+        print("Non è possibile procedere senza Mermaid CLI.")
+        return False
+    
+    # Senza cache persistente ne serve comunque una per la sessione, che
+    # permette ai documenti di condividere i diagrammi comuni
+    session_cache_dir = None
+    if args.no_cache:
+        session_cache_dir = tempfile.mkdtemp(prefix="mermaid_cache_")
+        cache_dir = session_cache_dir
+    else:
+        cache_dir = args.cache_dir or os.path.join(os.path.dirname(os.path.abspath(manifest_path)), DEFAULT_CACHE_DIRNAME)
+    cache = DiagramCache(cache_dir, max_bytes=args.cache_size_mb * 1024 * 1024)
+    renderer_cmd = shlex.split(args.renderer_cmd) if args.renderer_cmd else None
+    renderer = create_renderer(args.renderer, renderer_cmd)
+    
+    builds = []
+    try:
+        for document in documents:
+            print(f"\n=== Documento {document['name']}: {document['root']} ===")
+            with PROFILER.phase("prepare_document", document=document["name"]):
+                build = prepare_documentation(
+                    args, document["root"], mmdc_version, document["main_tex"], document["output"],
+                    cache=cache, renderer=renderer, build_name=document["build_name"]
+                )
+            builds.append((document, build))
+    finally:
+        renderer.close()
+        if session_cache_dir:
+            shutil.rmtree(session_cache_dir, ignore_errors=True)
+    
+    async def compile_all():
+        semaphore = asyncio.Semaphore(max(1, args.document_jobs))
+        
+        async def compile_one(document, build):
+            if build is None:
+                return False
+            async with semaphore:
+                print(f"\nCompilazione del documento {document['name']}...")
+                try:
+                    with PROFILER.phase("compile_document", document=document["name"]):
+                        return await asyncio.to_thread(compile_documentation, args, build)
+                except asyncio.CancelledError:
+                    # Il thread non si può cancellare: si fermano i suoi processi
+                    terminate_running_processes()
+                    raise
+        
+        return await asyncio.gather(*(compile_one(document, build) for document, build in builds))
+    
+    results = asyncio.run(compile_all())
+    print("\nRiepilogo dei documenti:")
+    for (document, build), ok in zip(builds, results):
+        target = os.path.join(document["root"], document["output"])
+        print(f"  {document['name']:<30} {'OK' if ok else 'ERRORE'}  {target if ok else ''}")
+    return all(results)
+
+def parse_args(argv=None):
+    """
+    Legge le opzioni da riga di comando.
+    """
+    parser = argparse.ArgumentParser(
+        description="Genera il PDF della documentazione convertendo i diagrammi Mermaid."
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=default_jobs(),
+        help="Numero massimo di render mmdc eseguiti in parallelo (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--cache-dir", default=None,
+        help=f"Directory della cache persistente dei diagrammi (default: ./{DEFAULT_CACHE_DIRNAME})"
+    )
+    parser.add_argument(
+        "--cache-size-mb", type=int, default=DEFAULT_CACHE_SIZE_MB,
+        help="Dimensione massima della cache oltre la quale si rimuovono le voci meno usate (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Disattiva la cache persistente e renderizza tutti i diagrammi"
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Mantiene temp_build e rielabora solo i capitoli modificati dall'ultima build"
+    )
+    parser.add_argument(
+        "--max-passes", type=int, default=DEFAULT_MAX_LATEX_PASSES,
+        help="Numero massimo di passaggi pdflatex (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--retry-failed", action="store_true",
+        help="Riprova anche i diagrammi in quarantena perché falliti in una build precedente"
+    )
+    parser.add_argument(
+        "--report-failures", action="store_true",
+        help="Al termine elenca i diagrammi non renderizzati con file, riga ed errore"
+    )
+    parser.add_argument(
+        "--render-timeout", type=float, default=DEFAULT_RENDER_TIMEOUT,
+        help="Secondi concessi a ogni tentativo di render prima di terminarlo (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--render-retries", type=int, default=DEFAULT_RENDER_RETRIES,
+        help="Nuovi tentativi con impostazioni alternative per i render falliti (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--retry-backoff", type=float, default=DEFAULT_RETRY_BACKOFF,
+        help="Attesa prima del primo nuovo tentativo, raddoppiata ai successivi (default: %(default)ss)"
+    )
+    parser.add_argument(
+        "--latex-timeout", type=float, default=DEFAULT_LATEX_TIMEOUT,
+        help="Secondi concessi a ogni passaggio pdflatex prima di terminarlo (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--abort-on-error", action="store_true",
+        help="Interrompe pdflatex al primo errore invece di completare il passaggio (gli errori fatali lo interrompono sempre)"
+    )
+    parser.add_argument(
+        "--diagram-format", choices=DIAGRAM_FORMATS, default="png",
+        help="Formato dei diagrammi: png, pdf nativo di mmdc, svg convertito in PDF, "
+             "oppure auto per scegliere in base alla dimensione del render (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--optimize-images", action="store_true",
+        help="Rifila, ridimensiona alla risoluzione di stampa e ricomprime i PNG dei diagrammi (richiede Pillow)"
+    )
+    parser.add_argument(
+        "--image-dpi", type=int, default=DEFAULT_IMAGE_DPI,
+        help="Risoluzione di stampa usata da --optimize-images (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--text-width-cm", type=float, default=DEFAULT_TEXT_WIDTH_CM,
+        help="Larghezza del testo sulla pagina in cm, per calcolare la risoluzione effettiva (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--image-colors", type=int, default=0,
+        help="Quantizza i PNG ottimizzati a questo numero di colori; 0 li ricomprime senza perdita (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--parallel-chapters", action="store_true",
+        help="Compila i capitoli in processi pdflatex paralleli con \\includeonly e unisce i PDF"
+    )
+    parser.add_argument(
+        "--latex-jobs", type=int, default=os.cpu_count() or 1,
+        help="Numero di processi pdflatex paralleli con --parallel-chapters (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--stage-mode", choices=STAGE_MODES, default="auto",
+        help="Come portare nella copia di build i file non modificati: reflink, hard link o copia (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--stage-include", action="append", default=[], metavar="GLOB",
+        help="Glob dei file da includere nella copia di build (ripetibile; default: tutti)"
+    )
+    parser.add_argument(
+        "--stage-exclude", action="append", default=[], metavar="GLOB",
+        help="Glob aggiuntivi di file o directory da escludere dalla copia di build (ripetibile)"
+    )
+    parser.add_argument(
+        "--renderer", choices=[SubprocessRenderer.name, BatchRenderer.name], default=SubprocessRenderer.name,
+        help="Backend di render: un processo mmdc per diagramma o una sessione Node/Puppeteer condivisa (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--renderer-cmd", default=None,
+        help="Comando alternativo per il renderer batch, ad esempio un renderer finto per i test"
+    )
+    parser.add_argument(
+        "--documents", default=None, metavar="MANIFEST",
+        help="Costruisce tutti i documenti elencati in un manifest JSON, condividendo cache e renderer"
+    )
+    parser.add_argument(
+        "--document-jobs", type=int, default=default_jobs(),
+        help="Numero massimo di documenti compilati in parallelo con --documents (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="Resta in esecuzione e ricompila in modo incrementale quando main.tex o i capitoli cambiano"
+    )
+    parser.add_argument(
+        "--debounce", type=float, default=DEFAULT_WATCH_DEBOUNCE,
+        help="Secondi di quiete attesi dopo l'ultimo salvataggio prima di ricompilare (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="Misura le fasi della build, stampa un riepilogo e salva una traccia JSON"
+    )
+    parser.add_argument(
+        "--profile-output", default=None,
+        help="Percorso della traccia in formato Chrome trace-event (default: temp_build/build_profile.json)"
+    )
+    parser.add_argument(
+        "--list-diagrams", action="store_true",
+        help="Stampa in JSON i metadati dei diagrammi Mermaid del progetto senza renderizzarli"
+    )
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    PROFILER.enabled = args.profile
+    
     # Imposta il percorso del progetto
     project_dir = os.getcwd()
-    main_tex = "main.tex"
-    output_pdf = "documentazione_finale.pdf"
-    
+    if args.list_diagrams:
+        print(json.dumps(diagram_metadata(project_dir), indent=2, ensure_ascii=False))
+        return
+    try:
+        if args.documents:
+            with PROFILER.phase("build"):
+                ok = build_documents(args, args.documents)
+            if not ok:
+                sys.exit(1)
+        elif args.watch:
+            # In modalità watch le ricompilazioni sono sempre incrementali
+            args.incremental = True
+            watch_and_rebuild(args, project_dir)
+        else:
+            with PROFILER.phase("build"):
+                build_documentation(args, project_dir)
+    except KeyboardInterrupt:
+        # asyncio ha già cancellato i task; si fermano anche i processi dei thread di lavoro
+        terminate_running_processes()
+        print("\nBuild interrotta dall'utente.")
+        sys.exit(130)
+    finally:
+        if args.profile:
+            PROFILER.print_summary()
+            trace_path = args.profile_output or os.path.join(project_dir, "temp_build", "build_profile.json")
+            os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+            PROFILER.write_trace(trace_path)
+            print(f"Traccia del profilo salvata in {trace_path}")
+
+def build_documentation(args, project_dir, mmdc_version=None, main_tex=DEFAULT_MAIN_TEX, output_pdf=DEFAULT_OUTPUT_PDF,
+                        cache=None, renderer=None):
+    """
+    Esegue l'intera pipeline: copia del progetto, conversione dei diagrammi
+    Mermaid, compilazione LaTeX e copia del PDF finale.
+    Se mmdc_version è già noto (modalità watch) la verifica di mmdc viene saltata.
+    """
+    build = prepare_documentation(args, project_dir, mmdc_version, main_tex, output_pdf, cache, renderer)
+    if build is not None:
+        compile_documentation(args, build)
+
+def prepare_documentation(args, project_dir, mmdc_version=None, main_tex=DEFAULT_MAIN_TEX, output_pdf=DEFAULT_OUTPUT_PDF,
+                          cache=None, renderer=None, build_name=None):
+    """
+    Prima metà della pipeline: copia del progetto e conversione dei diagrammi.
+    Una cache e un renderer passati dal chiamante vengono condivisi (e non
+    chiusi); altrimenti se ne creano di propri per questa build.
+    Con build_name la build usa temp_build/<build_name> invece di temp_build,
+    così più documenti della stessa root non condividono copia e file ausiliari.
+    Restituisce lo stato da passare a compile_documentation, o None se la
+    build non può proseguire.
+    """
     # Verifica che mmdc sia installato
-    if not check_mermaid_cli():
+    if mmdc_version is None:
+        with PROFILER.phase("check_mermaid_cli"):
+            mmdc_version = check_mermaid_cli()
+    if not mmdc_version:
         print("Non è possibile procedere senza Mermaid CLI.")
-        return
+        return None
+    
+    # La cache vive fuori da temp_build, così sopravvive alla pulizia iniziale
+    if cache is None and not args.no_cache:
+        cache_dir = args.cache_dir or os.path.join(project_dir, DEFAULT_CACHE_DIRNAME)
+        cache = DiagramCache(cache_dir, max_bytes=args.cache_size_mb * 1024 * 1024)
+    if cache is not None:
+        cache.reset_stats()
+    cache_dirname = os.path.basename(cache.cache_dir if cache is not None else args.cache_dir or DEFAULT_CACHE_DIRNAME)
     
     # Crea una cartella temporanea nel progetto per i processi
     temp_build_dir = os.path.join(project_dir, "temp_build")
-    if os.path.exists(temp_build_dir):
+    if build_name:
+        temp_build_dir = os.path.join(temp_build_dir, build_name)
+    manifest_path = os.path.join(temp_build_dir, BUILD_MANIFEST_FILENAME)
+    previous_manifest = {}
+    if args.incremental:
+        previous_manifest = load_build_manifest(manifest_path)
+    elif os.path.exists(temp_build_dir):
         shutil.rmtree(temp_build_dir)  # Pulisce la cartella se esiste già
-    os.makedirs(temp_build_dir)
+    os.makedirs(temp_build_dir, exist_ok=True)
 
     # Crea le sottocartelle per i vari processi
     project_temp = os.path.join(temp_build_dir, "project_copy")
@@ -427,57 +3089,150 @@ def main():
     pdf_output_dir = os.path.join(temp_build_dir, "pdf_output")
     os.makedirs(pdf_output_dir, exist_ok=True)
     
-    # Copia il progetto, escludendo la cartella temporanea
-    print(f"Creazione della copia temporanea del progetto in {project_temp}...")
-    copy_project(project_dir, project_temp, exclude_dirs=["temp_build"])
-    
-    # Modifica il preambolo del file principale per ottimizzare il layout
     main_tex_path = os.path.join(project_temp, main_tex)
-    modify_preamble(main_tex_path)
+    stage_exclude = DEFAULT_STAGE_EXCLUDES + [
+        cache_dirname, output_pdf, main_tex.replace(".tex", ".pdf")
+    ] + args.stage_exclude
+    stage_include = args.stage_include or None
     
-    # Elabora tutti i file .tex nella copia temporanea
-    process_all_tex_files(project_temp, png_dir, project_temp)
+    image_options = None
+    if args.optimize_images:
+        image_options = new_image_options(args.image_dpi, args.text_width_cm, args.image_colors)
+    # Le opzioni che cambiano i file generati invalidano la build incrementale
+    fingerprint_options = (args.diagram_format,)
+    if image_options is not None:
+        fingerprint_options += (json.dumps(image_options, sort_keys=True),)
     
-    # Applica ottimizzazioni aggiuntive al layout
-    optimize_layout_post_process(main_tex_path)
+    if args.incremental:
+        # Aggiorna la copia esistente e individua i file da rielaborare
+        print(f"Aggiornamento incrementale della copia del progetto in {project_temp}...")
+        quarantined = frozenset()
+        if cache is not None and not args.retry_failed:
+            backend = renderer.name if renderer is not None else args.renderer
+            quarantined = cache.quarantined_hashes(mmdc_version, backend)
+        with PROFILER.phase("copy_project", incremental=True):
+            manifest, tex_files, preamble_changed, stage_stats = sync_project_incremental(
+                project_dir, project_temp, png_dir, main_tex, previous_manifest,
+                pipeline_fingerprint(mmdc_version, fingerprint_options), include=stage_include,
+                exclude=stage_exclude, mode=args.stage_mode, quarantined=quarantined
+            )
+        if preamble_changed:
+            # Un preambolo diverso può rendere incompatibili i file ausiliari esistenti
+            for extension in LATEX_AUX_EXTENSIONS:
+                stale_aux = main_tex_path.replace(".tex", extension)
+                if os.path.exists(stale_aux):
+                    os.remove(stale_aux)
+        print(f"{len(tex_files)} file .tex da rielaborare")
+    else:
+        # Prepara la copia del progetto collegando i file che non verranno modificati
+        print(f"Creazione della copia temporanea del progetto in {project_temp}...")
+        with PROFILER.phase("copy_project"):
+            tex_files, stage_stats = stage_project(
+                project_dir, project_temp, main_tex=main_tex, include=stage_include,
+                exclude=stage_exclude, mode=args.stage_mode
+            )
+        manifest = None
+    print_stage_stats(stage_stats)
+    
+    # Elabora i file .tex nella copia temporanea; il file principale riceve nella
+    # stessa passata le modifiche al preambolo, le figure il layout pianificato per capitolo
+    rendered = {}
+    if tex_files:
+        own_renderer = renderer is None
+        if own_renderer:
+            renderer_cmd = shlex.split(args.renderer_cmd) if args.renderer_cmd else None
+            renderer = create_renderer(args.renderer, renderer_cmd)
+        try:
+            with PROFILER.phase("process_all_tex_files"):
+                rendered = process_all_tex_files(
+                    project_temp, png_dir, project_temp, jobs=max(1, args.jobs),
+                    cache=cache, renderer_version=mmdc_version, files=tex_files,
+                    renderer=renderer, main_tex_path=main_tex_path,
+                    diagram_format=args.diagram_format,
+                    policy=new_render_policy(args.render_timeout, args.render_retries, args.retry_backoff),
+                    retry_failed=args.retry_failed,
+                    image_options=image_options
+                )
+        finally:
+            if own_renderer:
+                renderer.close()
+    if cache is not None:
+        cache.save()
+        cache.print_stats()
+    if args.report_failures:
+        failures = {code: result["error"] for code, result in rendered.items() if result["image"] is None}
+        backend = renderer.name if renderer is not None else args.renderer
+        report_render_failures(project_dir, failures, cache, mmdc_version, stage_exclude, backend)
+    
+    final_pdf_path = os.path.join(project_temp, main_tex.replace(".tex", ".pdf"))
+    project_changed = tex_files or stage_stats["linked"] or stage_stats["copied"] or stage_stats["removed"]
+    if args.incremental and not project_changed and previous_manifest.get("compiled") and os.path.exists(final_pdf_path):
+        print("Nessuna modifica rilevata: compilazione LaTeX non necessaria.")
+        compile_needed = False
+    else:
+        compile_needed = True
+    
+    return {
+        "project_dir": project_dir,
+        "main_tex": main_tex,
+        "output_pdf": output_pdf,
+        "temp_build_dir": temp_build_dir,
+        "project_temp": project_temp,
+        "pdf_output_dir": pdf_output_dir,
+        "final_pdf_path": final_pdf_path,
+        "manifest": manifest,
+        "manifest_path": manifest_path,
+        "compile_needed": compile_needed,
+    }
 
-    # Compila il file principale con pdflatex (tre volte per garantire riferimenti corretti)
-    for compilation in range(3):
+def compile_documentation(args, build):
+    """
+    Seconda metà della pipeline: compilazione LaTeX della copia preparata da
+    prepare_documentation e copia del PDF finale.
+    Restituisce True se il PDF è stato generato.
+    """
+    project_dir = build["project_dir"]
+    main_tex = build["main_tex"]
+    output_pdf = build["output_pdf"]
+    project_temp = build["project_temp"]
+    pdf_output_dir = build["pdf_output_dir"]
+    final_pdf_path = build["final_pdf_path"]
+    manifest = build["manifest"]
+    
+    # Compila il file principale con pdflatex finché i riferimenti non si stabilizzano
+    if build["compile_needed"]:
         try:
-            print(f"\nAvvio compilazione LaTeX {compilation+1}/3...")
-            result = subprocess.run(
-                ["pdflatex", "-interaction=nonstopmode", "-shell-escape", main_tex], 
-                cwd=project_temp, check=False, capture_output=True, text=True
-            )
-            
-            # Mostra l'output di pdflatex indipendentemente dal successo
-            if result.returncode != 0:
-                print(f"\nERRORE nella compilazione {compilation+1}.")
-                if result.stderr:
-                    print("Errori specifici:")
-                    print(result.stderr)
-                error_lines = [line for line in result.stdout.split('\n') if 'error' in line.lower()]
-                if error_lines:
-                    print("\nErrori rilevati:")
-                    for line in error_lines[:10]:  # Mostra solo i primi 10 errori
-                        print(f" - {line.strip()}")
-            else:
-                print(f"\nCompilazione {compilation+1} completata con successo.")
-                
+            compiled = False
+            if args.parallel_chapters:
+                compiled = compile_chapters_parallel(
+                    project_temp, main_tex, build["temp_build_dir"], args.latex_jobs,
+                    max_passes=max(1, args.max_passes), timeout=args.latex_timeout,
+                    abort_on_error=args.abort_on_error
+                )
+            if not compiled:
+                compile_latex(
+                    project_temp, main_tex, max_passes=max(1, args.max_passes), timeout=args.latex_timeout,
+                    abort_on_error=args.abort_on_error,
+                    diagnostics_path=os.path.join(build["temp_build_dir"], LATEX_DIAGNOSTICS_FILENAME)
+                )
         except Exception as e:
             print(f"Eccezione durante la compilazione LaTeX: {str(e)}")
-            return
+            return False
+
+    if manifest is not None:
+        manifest["compiled"] = os.path.exists(final_pdf_path)
+        save_build_manifest(build["manifest_path"], manifest)
 
     # Copia il PDF finale nella directory di output
-    final_pdf_path = os.path.join(project_temp, main_tex.replace(".tex", ".pdf"))
     if os.path.exists(final_pdf_path):
         shutil.copy(final_pdf_path, os.path.join(pdf_output_dir, output_pdf))
         print(f"PDF generato correttamente: {os.path.join(pdf_output_dir, output_pdf)}")
         # Copia anche nella directory principale per comodità
         shutil.copy(final_pdf_path, os.path.join(project_dir, output_pdf))
         print(f"PDF copiato anche nella directory principale: {os.path.join(project_dir, output_pdf)}")
-    else:
-        print("Errore: PDF non generato.")
+        return True
+    print("Errore: PDF non generato.")
+    return False
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,79 @@
+// Renderer Mermaid batch per luppoloabirra_latex.py (--renderer batch).
+//
+// Avvia un solo browser Puppeteer e lo riusa per tutti i diagrammi della build.
+// Protocollo: una volta avviato il browser scrive {"ready": true} su stdout,
+// poi legge una richiesta JSON per riga su stdin
+//   {"id", "source", "config", "width", "height", "background", "format"}
+// e una risposta JSON per riga su stdout
+//   {"id", "ok": true, "data": "<base64>"} oppure {"id", "ok": false, "error": "..."}
+// dove "format" è "png" (predefinito), "svg" o "pdf".
+
+import { execSync } from "node:child_process";
+import { createRequire } from "node:module";
+import path from "node:path";
+import readline from "node:readline";
+import { pathToFileURL } from "node:url";
+
+async function importFromGlobal(specifier) {
+  // mermaid-cli di solito è installato globalmente (npm install -g), fuori
+  // dalla risoluzione dei moduli ESM: si ripiega sulla root globale di npm.
+  try {
+    return await import(specifier);
+  } catch (error) {
+    const globalRoot = execSync("npm root -g", { encoding: "utf-8" }).trim();
+    const require = createRequire(path.join(globalRoot, "@mermaid-js", "mermaid-cli", "package.json"));
+    return await import(pathToFileURL(require.resolve(specifier)).href);
+  }
+}
+
+const { renderMermaid } = await importFromGlobal("@mermaid-js/mermaid-cli");
+const puppeteer = (await importFromGlobal("puppeteer")).default;
+
+const browser = await puppeteer.launch({ headless: "new" });
+
+function reply(message) {
+  process.stdout.write(JSON.stringify(message) + "\n");
+}
+
+// Il lato Python attende questa riga prima di inviare richieste
+reply({ ready: true });
+
+async function handle(request) {
+  try {
+    const format = request.format || "png";
+    const options = {
+      backgroundColor: request.background || "white",
+      mermaidConfig: request.config || {},
+      pdfFit: format === "pdf",
+    };
+    if (request.width && request.height) {
+      options.viewport = { width: request.width, height: request.height, deviceScaleFactor: 1 };
+    }
+    const { data } = await renderMermaid(browser, request.source, format, options);
+    reply({ id: request.id, ok: true, data: Buffer.from(data).toString("base64") });
+  } catch (error) {
+    reply({ id: request.id, ok: false, error: String(error && error.message ? error.message : error) });
+  }
+}
+
+const pending = new Set();
+const lines = readline.createInterface({ input: process.stdin });
+
+for await (const line of lines) {
+  if (!line.trim()) {
+    continue;
+  }
+  let request;
+  try {
+    request = JSON.parse(line);
+  } catch (error) {
+    reply({ id: null, ok: false, error: `richiesta non valida: ${error.message}` });
+    continue;
+  }
+  // Le richieste sono servite in parallelo su pagine diverse dello stesso browser
+  const task = handle(request).finally(() => pending.delete(task));
+  pending.add(task);
+}
+
+await Promise.all(pending);
+await browser.close();